@@ -31,10 +31,15 @@ setup(
         'Flask-Mako',
         'lxml'
     ],
+    extras_require={
+        'speedups': ['numpy'],
+        'gevent': ['gevent'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update_xml = presence_analyzer.script:update_user_data
+    presence-bench = presence_analyzer.benchmarks:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -2,5 +2,11 @@
 """
 Presence analyzer.
 """
+from . import gevent_server
+
+# before Flask gets imported, see gevent_server
+gevent_server.patch_from_environ()
+
+# pylint: disable=wrong-import-position
 from .main import app
 from . import views
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user statistics precomputed once per data load.
+"""
+from datetime import date
+
+from . import vectorized
+from .metrics import timed
+
+
+class UserAggregates(object):
+    """
+    Weekday and monthly sums of a single user's presence.
+
+    Per weekday (0 is Monday) it keeps number of days, total presence
+    and sums of start and end times, all in seconds. ``months`` maps
+    ``(year, month)`` to ``[days, hours]``, where hours are whole hours
+    of every day added up, the same as group_by_average_monthly_hours.
+    ``month_hours`` and ``month_years`` fold these by month of year.
+    ``last_day`` is ordinal of the latest day added.
+    """
+
+    def __init__(self):
+        self.counts = [0] * 7
+        self.intervals = [0] * 7
+        self.starts = [0] * 7
+        self.ends = [0] * 7
+        self.months = {}
+        self.month_hours = [0] * 12
+        self.month_years = [0] * 12
+        self.last_day = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds aggregates of ``(date ordinal, start, end)`` rows.
+        """
+        aggregates = cls()
+        aggregates.add_rows(rows)
+        return aggregates
+
+    @classmethod
+    def from_sums(cls, sums):
+        """
+        Builds aggregates of sums computed elsewhere, see vectorized.
+        """
+        aggregates = cls()
+        for name, value in sums.iteritems():
+            setattr(aggregates, name, value)
+        return aggregates
+
+    def copy(self):
+        """
+        Returns independent copy of aggregates.
+        """
+        aggregates = UserAggregates()
+        for name in ('counts', 'intervals', 'starts', 'ends',
+                     'month_hours', 'month_years'):
+            setattr(aggregates, name, list(getattr(self, name)))
+        aggregates.months = {
+            month: list(sums) for month, sums in self.months.iteritems()
+        }
+        aggregates.last_day = self.last_day
+        return aggregates
+
+    def add_rows(self, rows):
+        """
+        Adds ``(date ordinal, start, end)`` rows of days not added yet.
+        """
+        for ordinal, start, end in rows:
+            weekday = (ordinal - 1) % 7
+            self.counts[weekday] += 1
+            self.intervals[weekday] += end - start
+            self.starts[weekday] += start
+            self.ends[weekday] += end
+            day = date.fromordinal(ordinal)
+            hours = (end - start) // 3600
+            if (day.year, day.month) not in self.months:
+                self.months[day.year, day.month] = [0, 0]
+                self.month_years[day.month - 1] += 1
+            self.months[day.year, day.month][0] += 1
+            self.months[day.year, day.month][1] += hours
+            self.month_hours[day.month - 1] += hours
+            self.last_day = max(self.last_day, ordinal)
+
+    def add(self, other):
+        """
+        Adds sums of other aggregates, as if their rows were added.
+        """
+        for name in ('counts', 'intervals', 'starts', 'ends', 'month_hours'):
+            sums = getattr(self, name)
+            for i, value in enumerate(getattr(other, name)):
+                sums[i] += value
+        for (year, month), (days, hours) in other.months.iteritems():
+            if (year, month) not in self.months:
+                self.months[year, month] = [0, 0]
+                self.month_years[month - 1] += 1
+            self.months[year, month][0] += days
+            self.months[year, month][1] += hours
+        self.last_day = max(self.last_day, other.last_day)
+
+    def weekday_totals(self):
+        """
+        Total presence in seconds by weekday.
+        """
+        return list(self.intervals)
+
+    def weekday_means(self):
+        """
+        Mean presence in seconds by weekday.
+        """
+        return [
+            _mean(total, count)
+            for total, count in zip(self.intervals, self.counts)
+        ]
+
+    def start_end_means(self):
+        """
+        ``[weekday, mean start, mean end]`` for every weekday.
+        """
+        return [
+            [
+                weekday,
+                _mean(self.starts[weekday], self.counts[weekday]),
+                _mean(self.ends[weekday], self.counts[weekday]),
+            ]
+            for weekday in xrange(7)
+        ]
+
+    def monthly_averages(self):
+        """
+        Average hours per month of year, ``[]`` for months without data.
+        """
+        return [
+            total / count if count else []
+            for total, count in zip(self.month_hours, self.month_years)
+        ]
+
+
+def _mean(total, count):
+    """
+    Arithmetic mean of ``count`` items adding up to ``total``.
+    """
+    return float(total) / count if count else 0
+
+
+def group_aggregates(index, users):
+    """
+    Sums aggregates of all users and of every group in one pass.
+
+    ``index`` is ``{user_id: UserAggregates}``, ``users`` the users map
+    where users may list their ``groups``. Returns ``(everyone, groups)``
+    with ``groups`` mapping group names to ``(members, aggregates)``.
+    """
+    everyone = UserAggregates()
+    groups = {}
+    for user_id in index:
+        aggregates = index.get(user_id)
+        if aggregates is None:
+            # lazily indexed user without valid rows
+            continue
+        everyone.add(aggregates)
+        for group in users.get(user_id, {}).get('groups', ()):
+            if group not in groups:
+                groups[group] = [0, UserAggregates()]
+            groups[group][0] += 1
+            groups[group][1].add(aggregates)
+    return everyone, {
+        group: (members, aggregates)
+        for group, (members, aggregates) in groups.iteritems()
+    }
+
+
+@timed
+def build_aggregates(store, user_ids=None, previous=None, tail=None,
+                     engine='auto'):
+    """
+    Builds ``{user_id: UserAggregates}`` index of a PresenceStore.
+
+    When ``previous`` index is given only ``user_ids`` are recomputed
+    and the rest is reused, which keeps tail reloads cheap. Users whose
+    rows in ``tail`` store all come after their last previous day just
+    get these rows added, so appending costs the same regardless of
+    how much history there is. Other users are aggregated with NumPy
+    when installed, unless ``engine`` is "python".
+    """
+    index = dict(previous) if previous is not None else {}
+    if user_ids is None:
+        user_ids = store.offsets
+    rebuilt = []
+    for user_id in user_ids:
+        aggregates = index.get(user_id)
+        if aggregates is not None and tail is not None and \
+                user_id in tail and \
+                tail[user_id].rows()[0][0] > aggregates.last_day:
+            aggregates = aggregates.copy()
+            aggregates.add_rows(tail[user_id].rows())
+            index[user_id] = aggregates
+        else:
+            rebuilt.append(user_id)
+    if engine != 'python' and vectorized.available():
+        for user_id, sums in vectorized.aggregate_users(store, rebuilt):
+            index[user_id] = UserAggregates.from_sums(sums)
+    else:
+        for user_id in rebuilt:
+            index[user_id] = UserAggregates.from_rows(store[user_id].rows())
+    return index
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks over synthetic datasets.
+
+Run with ``bin/presence-bench --users 1000 --years 10 --output run.json``;
+see ``--help`` for all options. Results are JSON, so runs can be compared.
+"""
+import argparse
+import datetime
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from . import gevent_server, utils
+from .ingest import CSVLoader, PARSERS, read_presence_rows
+from .main import app
+from .serializers import JSON_BACKENDS, LOSSY_JSON_BACKENDS, get_dumps
+from .utils import get_data
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..',
+    'runtime', 'data', 'sample_data.csv'
+)
+USERS_XML = os.path.join(
+    os.path.dirname(__file__), '..', '..',
+    'runtime', 'data', 'users.xml'
+)
+STATISTICS_ENDPOINTS = (
+    'mean_time_weekday',
+    'presence_weekday',
+    'presence_start_end',
+    'average_by_month',
+)
+# /api/v1 endpoints measured per user, ``{0}`` is the user id
+ENDPOINT_URLS = (
+    ('users', '/api/v1/users'),
+    ('user', '/api/v1/users/{0}'),
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/{0}'),
+    ('presence_weekday', '/api/v1/presence_weekday/{0}'),
+    ('presence_start_end', '/api/v1/presence_start_end/{0}'),
+    ('average_by_month', '/api/v1/average_by_month/{0}'),
+    ('bulk', '/api/v1/bulk?users={0}'),
+)
+FIRST_DAY = datetime.date(2010, 1, 1)
+
+
+def generate_csv(path, users, years, seed=0):
+    """
+    Writes presence CSV of ``users`` users over ``years`` years.
+
+    Rows are appended day by day like the real file grows; every user is
+    present on about 90% of working days. The same seed gives the same
+    file. Returns number of rows.
+    """
+    rand = random.Random(seed)
+    rows = 0
+    day = FIRST_DAY
+    last_day = FIRST_DAY.replace(year=FIRST_DAY.year + years)
+    with open(path, 'w') as csvfile:
+        while day < last_day:
+            if day.weekday() < 5:
+                iso_day = day.isoformat()
+                for user_id in xrange(1, users + 1):
+                    if rand.random() < 0.1:
+                        continue
+                    start = rand.randint(7 * 3600, 10 * 3600)
+                    end = start + rand.randint(6 * 3600, 9 * 3600)
+                    csvfile.write('{0},{1},{2},{3}\n'.format(
+                        user_id, iso_day, _format_time(start),
+                        _format_time(end)
+                    ))
+                    rows += 1
+            day += datetime.timedelta(days=1)
+    return rows
+
+
+def _format_time(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+def generate_users_xml(path, users):
+    """
+    Writes users.xml describing users with ids 1 to ``users``.
+    """
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1}</name>\n'
+                '        </user>\n'.format(
+                    user_id, escape('User {0}'.format(user_id))
+                )
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def best_of(repeat, function, *args, **kwargs):
+    """
+    Returns the best wall clock time of ``repeat`` calls and last result.
+    """
+    best, result = None, None
+    for _ in xrange(repeat):
+        started = time.time()
+        result = function(*args, **kwargs)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def count_rows(path, parser):
+    """
+    Parses whole CSV file with given parser and returns number of rows.
+    """
+    with open(path, 'r') as csvfile:
+        return sum(1 for _ in read_presence_rows(csvfile, parser))
+
+
+def bench_parsers(path, repeat=5):
+    """
+    Measures rows/sec of every CSV parser.
+    """
+    results = {}
+    for parser in sorted(PARSERS):
+        seconds, rows = best_of(repeat, count_rows, path, parser)
+        results[parser] = {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds else None,
+        }
+    return results
+
+
+def endpoint_payloads(user_ids):
+    """
+    Fetches decoded results of /api/v1 endpoints for given users.
+    """
+    client = app.test_client()
+    payloads = {
+        'users': [json.loads(client.get('/api/v1/users').data)],
+    }
+    for endpoint in STATISTICS_ENDPOINTS:
+        payloads[endpoint] = [
+            json.loads(client.get(
+                '/api/v1/{0}/{1}'.format(endpoint, user_id)
+            ).data)
+            for user_id in user_ids
+        ]
+    return payloads
+
+
+def bench_serializers(payloads, repeat=5):
+    """
+    Measures serialization time per response of every JSON backend.
+    """
+    results = {}
+    for backend in list(JSON_BACKENDS) + list(LOSSY_JSON_BACKENDS):
+        dumps = get_dumps(backend)
+        results[backend] = {}
+        for endpoint, values in payloads.iteritems():
+            seconds, _ = best_of(
+                repeat, lambda values=values: [dumps(v) for v in values]
+            )
+            results[backend][endpoint] = {
+                'responses': len(values),
+                'usec_per_response': seconds / len(values) * 1e6,
+            }
+    return results
+
+
+def percentiles(samples):
+    """
+    Summarizes durations in seconds as milliseconds.
+    """
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1e3,
+        'p50_ms': samples[len(samples) // 2] * 1e3,
+        'p95_ms': samples[int(len(samples) * 0.95)] * 1e3,
+        'max_ms': samples[-1] * 1e3,
+    }
+
+
+def _ingest(path, parser, results):
+    """
+    Loads CSV into a fresh loader and reports time and peak memory.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    store = CSVLoader().load(path, parser)
+    results.put({
+        'rows': store.row_count,
+        'users': len(store),
+        'seconds': time.time() - started,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_growth_kb': (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        ),
+        'store_bytes': store.memory_size(),
+    })
+
+
+def bench_ingest(path, parser='fast'):
+    """
+    Measures full load of CSV file, in a child process so the peak
+    memory is not skewed by earlier runs.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_ingest, args=(path, parser, results)
+    )
+    process.start()
+    result = results.get()
+    process.join()
+    result['rows_per_sec'] = (
+        result['rows'] / result['seconds'] if result['seconds'] else None
+    )
+    return result
+
+
+def drop_caches():
+    """
+    Forgets loaded presence data and users, so the next request
+    has to load them again.
+    """
+    utils.LOADER = CSVLoader()
+    for entries in utils.STORAGE.itervalues():
+        entries.clear()
+    utils.USERS['DATA'] = None
+    utils.USERS_LISTING['DATA'] = None
+
+
+def bench_endpoints(user_ids, repeat=20):
+    """
+    Measures latency of every /api/v1 endpoint on a cache miss, that is
+    the first request after drop_caches(), and on cache hits.
+    """
+    client = app.test_client()
+    results = {}
+    for name, url in ENDPOINT_URLS:
+        urls = [url.format(user_id) for user_id in user_ids]
+        drop_caches()
+        started = time.time()
+        status = client.get(urls[0]).status_code
+        miss = time.time() - started
+        hits = []
+        for i in xrange(repeat):
+            started = time.time()
+            client.get(urls[i % len(urls)])
+            hits.append(time.time() - started)
+        results[name] = {
+            'status': status,
+            'miss_ms': miss * 1e3,
+            'hit': percentiles(hits),
+        }
+    return results
+
+
+def bench_throughput(user_ids, threads, requests):
+    """
+    Measures requests/sec of ``threads`` threads sending ``requests``
+    requests each, spread over all endpoints and given users.
+    """
+    urls = [
+        url.format(user_id)
+        for _, url in ENDPOINT_URLS if url != '/api/v1/bulk?users={0}'
+        for user_id in user_ids
+    ]
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        """
+        Sends requests with its own test client.
+        """
+        client = app.test_client()
+        own = []
+        for i in xrange(requests):
+            started = time.time()
+            client.get(urls[(offset + i) % len(urls)])
+            own.append(time.time() - started)
+        with lock:
+            latencies.extend(own)
+
+    get_data()
+    workers = [
+        threading.Thread(target=worker, args=(i * requests,))
+        for i in xrange(threads)
+    ]
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.time() - started
+    return {
+        'threads': threads,
+        'requests': threads * requests,
+        'seconds': seconds,
+        'requests_per_sec': threads * requests / seconds,
+        'latency': percentiles(latencies),
+    }
+
+
+def _free_port():
+    """
+    Returns a TCP port free on localhost.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _run_server(server, port, threads):
+    """
+    Serves app with given server, in a child process.
+    """
+    if server == 'gevent':
+        gevent_server.serve(app, '127.0.0.1', port, threads)
+        return
+    try:
+        from paste import httpserver # pylint: disable=import-error
+    except ImportError:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+    else:
+        # the way deploy.ini serves the app
+        httpserver.serve(
+            app, '127.0.0.1', port, use_threadpool=True,
+            threadpool_workers=threads
+        )
+
+
+def _request(port, url):
+    """
+    Sends GET request and returns its status code.
+    """
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('GET', url)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def bench_server(server, user_ids, concurrency, requests, threads=50):
+    """
+    Load tests the app served over HTTP by ``server``, "threaded" (Paste
+    threadpool, like deploy.ini) or "gevent", with ``concurrency``
+    clients sending ``requests`` requests in total.
+    """
+    port = _free_port()
+    process = multiprocessing.Process(
+        target=_run_server, args=(server, port, threads)
+    )
+    process.start()
+    try:
+        for _ in xrange(100):
+            try:
+                _request(port, '/api/v1/status')
+                break
+            except socket.error:
+                time.sleep(0.1)
+        urls = [
+            url.format(user_id)
+            for _, url in ENDPOINT_URLS
+            for user_id in user_ids
+        ]
+        for url in urls:
+            _request(port, url)
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def client(offset):
+            """
+            Sends its share of requests one after another.
+            """
+            own, failed = [], 0
+            for i in xrange(offset, requests, concurrency):
+                started = time.time()
+                try:
+                    if _request(port, urls[i % len(urls)]) != 200:
+                        failed += 1
+                except (socket.error, httplib.HTTPException):
+                    failed += 1
+                own.append(time.time() - started)
+            with lock:
+                latencies.extend(own)
+                errors[0] += failed
+
+        clients = [
+            threading.Thread(target=client, args=(i,))
+            for i in xrange(concurrency)
+        ]
+        started = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        seconds = time.time() - started
+    finally:
+        process.terminate()
+        process.join()
+    result = {
+        'server': server,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': seconds,
+        'requests_per_sec': len(latencies) / seconds,
+        'latency': percentiles(latencies),
+    }
+    latencies.sort()
+    result['latency']['p99_ms'] = latencies[int(len(latencies) * 0.99)] * 1e3
+    return result
+
+
+def parse_args(argv):
+    """
+    Parses command line options.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark presence analyzer on synthetic data.'
+    )
+    parser.add_argument(
+        'csv', nargs='?',
+        help='existing presence CSV to use instead of generated one'
+    )
+    parser.add_argument('--users-xml', help='users.xml for given CSV')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--sample', type=int, default=20,
+        help='number of users requested in endpoint benchmarks'
+    )
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument(
+        '--threads', default='1,4,8',
+        help='comma separated numbers of concurrent threads'
+    )
+    parser.add_argument(
+        '--requests', type=int, default=200,
+        help='requests sent by every thread'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=20,
+        help='concurrent HTTP clients of the server load test'
+    )
+    parser.add_argument(
+        '--server-requests', type=int, default=2000,
+        help='requests sent in the server load test, 0 skips it'
+    )
+    parser.add_argument('--output', help='write JSON results to file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs all benchmarks and writes results as JSON.
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    workdir = None
+    if args.csv:
+        path = args.csv
+        users_xml = args.users_xml or USERS_XML
+        dataset = {'csv': path}
+    else:
+        workdir = tempfile.mkdtemp(prefix='presence-bench-')
+        path = os.path.join(workdir, 'presence.csv')
+        users_xml = os.path.join(workdir, 'users.xml')
+        dataset = {
+            'users': args.users,
+            'years': args.years,
+            'seed': args.seed,
+            'rows': generate_csv(path, args.users, args.years, args.seed),
+        }
+        generate_users_xml(users_xml, args.users)
+    try:
+        dataset['bytes'] = os.path.getsize(path)
+        app.config.update({
+            'DATA_CSV': path,
+            'DATA_USERS_XML': users_xml,
+            'DATA_SNAPSHOT': False,
+        })
+        drop_caches()
+        user_ids = sorted(get_data())
+        sample = random.Random(args.seed).sample(
+            user_ids, min(args.sample, len(user_ids))
+        )
+        results = {
+            'dataset': dataset,
+            'ingest': bench_ingest(path),
+            'parsers': bench_parsers(path, repeat=3),
+            'serializers': bench_serializers(endpoint_payloads(sample)),
+            'endpoints': bench_endpoints(sample, args.repeat),
+            'throughput': [
+                bench_throughput(sample, int(threads), args.requests)
+                for threads in args.threads.split(',')
+            ],
+            'servers': [
+                bench_server(
+                    server, sample, args.concurrency, args.server_requests
+                )
+                for server in ('threaded', 'gevent')
+                if args.server_requests and
+                (server != 'gevent' or gevent_server.available())
+            ],
+        }
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as result_file:
+            result_file.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage backend.
+
+Presence rows are imported from the CSV export into an SQLite file by
+sync_database(), run from ``bin/flask-ctl sync``. Workers read it
+through SQLiteBackend: users are fetched one by one and statistics come
+from per-user weekday and month rollup tables, which triggers keep in
+step with the rows, so the dataset doesn't have to fit in memory and
+statistics don't get slower with years of history.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from collections import Mapping
+
+from .aggregates import UserAggregates
+from .ingest import _track_lines, read_presence_rows
+from .store import PresenceStore
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# julian day of the midnight starting date ordinal 0
+JULIAN_OFFSET = 1721424.5
+# lowest and highest date ordinals
+ALL_DAYS = (1, 3652059)
+
+
+def _year(row):
+    """
+    SQL expression of year of ``row``'s day.
+    """
+    return "CAST(strftime('%Y', {0}.day + {1}) AS INTEGER)".format(
+        row, JULIAN_OFFSET
+    )
+
+
+def _month(row):
+    """
+    SQL expression of month of ``row``'s day.
+    """
+    return "CAST(strftime('%m', {0}.day + {1}) AS INTEGER)".format(
+        row, JULIAN_OFFSET
+    )
+
+
+def _hours(row):
+    """
+    SQL expression of whole hours of ``row``, floored like in Python.
+    """
+    return (
+        '(({0}.end_time - {0}.start_time) - '
+        '(({0}.end_time - {0}.start_time) % 3600 + 3600) % 3600) / 3600'
+    ).format(row)
+
+
+def _rollup_trigger(event, row, sign):
+    """
+    Returns trigger adding (``sign`` "+") or subtracting (``sign`` "-")
+    ``row`` of presence to or from the rollups.
+    """
+    values = {
+        'row': row,
+        'sign': sign,
+        'weekday': '({0}.day - 1) % 7'.format(row),
+        'year': _year(row),
+        'month': _month(row),
+        'hours': _hours(row),
+    }
+    return """
+CREATE TRIGGER presence_{event} AFTER {event} ON presence BEGIN
+    INSERT INTO weekday_rollup
+        SELECT {row}.user_id, {weekday}, 0, 0, 0, 0 WHERE NOT EXISTS (
+            SELECT 1 FROM weekday_rollup
+            WHERE user_id = {row}.user_id AND weekday = {weekday}
+        );
+    UPDATE weekday_rollup SET
+        days = days {sign} 1,
+        seconds = seconds {sign} ({row}.end_time - {row}.start_time),
+        start_sum = start_sum {sign} {row}.start_time,
+        end_sum = end_sum {sign} {row}.end_time
+        WHERE user_id = {row}.user_id AND weekday = {weekday};
+    INSERT INTO month_rollup
+        SELECT {row}.user_id, {year}, {month}, 0, 0 WHERE NOT EXISTS (
+            SELECT 1 FROM month_rollup WHERE user_id = {row}.user_id
+            AND year = {year} AND month = {month}
+        );
+    UPDATE month_rollup SET
+        days = days {sign} 1,
+        hours = hours {sign} {hours}
+        WHERE user_id = {row}.user_id AND year = {year} AND month = {month};
+    DELETE FROM weekday_rollup WHERE user_id = {row}.user_id AND days = 0;
+    DELETE FROM month_rollup WHERE user_id = {row}.user_id AND days = 0;
+END""".format(event=event, **values)
+
+
+# days are date ordinals, times are seconds since midnight; a row
+# replaced by a later one of the same day is deleted first, so its
+# share of the rollups is subtracted (triggers must not use OR IGNORE,
+# INSERT OR REPLACE of presence would override it)
+SCHEMA_VERSION = 2
+SCHEMA = (
+    """
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID""",
+    """
+CREATE TABLE weekday_rollup (
+    user_id INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    days INTEGER NOT NULL,
+    seconds INTEGER NOT NULL,
+    start_sum INTEGER NOT NULL,
+    end_sum INTEGER NOT NULL,
+    PRIMARY KEY (user_id, weekday)
+) WITHOUT ROWID""",
+    """
+CREATE TABLE month_rollup (
+    user_id INTEGER NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    days INTEGER NOT NULL,
+    hours INTEGER NOT NULL,
+    PRIMARY KEY (user_id, year, month)
+) WITHOUT ROWID""",
+    """
+CREATE TABLE source (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    path TEXT,
+    device INTEGER,
+    inode INTEGER,
+    size INTEGER,
+    mtime REAL,
+    offset INTEGER,
+    version INTEGER NOT NULL
+)""",
+    _rollup_trigger('INSERT', 'NEW', '+'),
+    _rollup_trigger('DELETE', 'OLD', '-'),
+)
+TABLES = ('presence', 'weekday_rollup', 'month_rollup', 'source')
+
+
+def connect(path):
+    """
+    Opens database file in autocommit mode, transactions are explicit.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('PRAGMA recursive_triggers = ON')
+    return connection
+
+
+def schema_version(connection):
+    """
+    Returns version of the schema database was created with.
+    """
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _reset(connection):
+    """
+    Recreates all tables empty, much faster than deleting the rows
+    one by one through the triggers.
+    """
+    for table in TABLES:
+        connection.execute('DROP TABLE IF EXISTS {0}'.format(table))
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+
+
+def sync_database(csv_path, db_path, parser='fast'):
+    """
+    Brings database up to date with CSV file.
+
+    Like CSVLoader it imports only rows appended since the last sync
+    and starts over when the file was truncated or replaced, or the
+    database has an older schema. Later rows of the same user and day
+    win. Returns True if anything was imported.
+    """
+    connection = connect(db_path)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            synced = _sync(connection, csv_path, parser)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return synced
+    finally:
+        connection.close()
+
+
+def _sync(connection, csv_path, parser):
+    """
+    Imports new rows of CSV file within a transaction.
+    """
+    stat = os.stat(csv_path)
+    source = None
+    if schema_version(connection) == SCHEMA_VERSION:
+        source = connection.execute(
+            'SELECT path, device, inode, size, mtime, offset, version '
+            'FROM source'
+        ).fetchone()
+    path, device, inode, size, mtime, offset, version = \
+        source or (None, None, None, 0, None, 0, 0)
+    if (csv_path, stat.st_dev, stat.st_ino) != (path, device, inode) or \
+            stat.st_size < size or \
+            (stat.st_size == size and stat.st_mtime != mtime):
+        _reset(connection)
+        offset = 0
+    elif stat.st_size == size:
+        return False
+    elif offset < size:
+        # the unterminated last line is read again below; its row goes
+        # first, through the rollup triggers, so that a line completed
+        # into another row or into a malformed one doesn't leave it
+        # behind
+        with open(csv_path, 'rb') as csvfile:
+            csvfile.seek(offset)
+            fragment = csvfile.read(size - offset)
+        connection.executemany(
+            'DELETE FROM presence WHERE user_id = ? AND day = ?',
+            [row[:2] for row in read_presence_rows([fragment], parser)]
+        )
+    position = [offset, offset]
+    with open(csv_path, 'rb') as csvfile:
+        csvfile.seek(offset)
+        connection.executemany(
+            'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+            read_presence_rows(_track_lines(csvfile, position), parser)
+        )
+    connection.execute(
+        'INSERT OR REPLACE INTO source VALUES (1, ?, ?, ?, ?, ?, ?, ?)',
+        (csv_path, stat.st_dev, stat.st_ino, position[1], stat.st_mtime,
+         position[0], version + 1)
+    )
+    log.info('Synced %s up to byte %d', csv_path, position[0])
+    return True
+
+
+class SQLiteBackend(object):
+    """
+    Serves presence data from a database filled by sync_database().
+
+    It can stand in for CSVLoader: ``store`` maps user ids to their
+    UserPresence and ``aggregates`` to their UserAggregates, both read
+    from the database on access. ``version`` follows the number of
+    syncs, ``size`` and ``mtime`` describe the CSV file as last synced.
+    Every thread gets its own connection.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.path = None
+        self.store = None
+        self.aggregates = {}
+        self.version = 0
+        self.size = 0
+        self.mtime = None
+        self.background = False
+
+    def load(self, path):
+        """
+        Returns presence data of given database file.
+        """
+        with self.lock:
+            if path != self.path:
+                self.path = path
+                self.store = SQLitePresence(self)
+                self.aggregates = SQLiteAggregates(self)
+            if schema_version(self.connection()) != SCHEMA_VERSION:
+                raise IOError(
+                    'Database {0} has to be synced first'.format(path)
+                )
+            row = self.query(
+                'SELECT version, size, mtime FROM source'
+            ).fetchone()
+            self.version, self.size, self.mtime = row or (0, 0, None)
+            return self.store
+
+    def connection(self):
+        """
+        Returns connection of the current thread.
+        """
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        if self.path not in connections:
+            connections[self.path] = connect(self.path)
+        return connections[self.path]
+
+    def query(self, sql, parameters=()):
+        """
+        Executes query on connection of the current thread.
+        """
+        return self.connection().execute(sql, parameters)
+
+    def user_ids(self):
+        """
+        Returns sorted ids of users with any presence.
+        """
+        return [
+            user_id for user_id, in self.query(
+                'SELECT DISTINCT user_id FROM weekday_rollup ORDER BY 1'
+            )
+        ]
+
+    def has_user(self, user_id):
+        """
+        Checks if user has any presence.
+        """
+        return self.query(
+            'SELECT 1 FROM weekday_rollup WHERE user_id = ? LIMIT 1',
+            (user_id,)
+        ).fetchone() is not None
+
+    def user_aggregates(self, user_id, first=None, last=None):
+        """
+        Aggregates presence of user between ``first`` and ``last`` dates.
+
+        Without dates the rollups are read, otherwise rows of the range
+        are aggregated.
+        """
+        aggregates = UserAggregates()
+        if first is None and last is None:
+            weekdays = self.query(
+                'SELECT weekday, days, seconds, start_sum, end_sum '
+                'FROM weekday_rollup WHERE user_id = ?', (user_id,)
+            )
+            months = self.query(
+                'SELECT year, month, days, hours FROM month_rollup '
+                'WHERE user_id = ?', (user_id,)
+            )
+            days = (user_id,) + ALL_DAYS
+        else:
+            days = (user_id,) + _day_range(first, last)
+            weekdays = self.query(
+                'SELECT (day - 1) % 7, COUNT(*), SUM(end_time - start_time), '
+                'SUM(start_time), SUM(end_time) FROM presence '
+                'WHERE user_id = ? AND day BETWEEN ? AND ? GROUP BY 1', days
+            )
+            months = self.query(
+                'SELECT {0}, {1}, COUNT(*), SUM({2}) FROM presence '
+                'WHERE user_id = ? AND day BETWEEN ? AND ? '
+                'GROUP BY 1, 2'.format(
+                    _year('presence'), _month('presence'),
+                    _hours('presence')
+                ), days
+            )
+        for weekday, count, interval, start, end in weekdays:
+            aggregates.counts[weekday] = count
+            aggregates.intervals[weekday] = interval
+            aggregates.starts[weekday] = start
+            aggregates.ends[weekday] = end
+        for year, month, count, hours in months:
+            aggregates.months[year, month] = [count, hours]
+            aggregates.month_hours[month - 1] += hours
+            aggregates.month_years[month - 1] += 1
+        aggregates.last_day = self.query(
+            'SELECT MAX(day) FROM presence '
+            'WHERE user_id = ? AND day BETWEEN ? AND ?', days
+        ).fetchone()[0]
+        return aggregates
+
+    def user_presence(self, user_id):
+        """
+        Returns UserPresence of user, None if there is no presence.
+        """
+        store = PresenceStore.from_rows(self.query(
+            'SELECT user_id, day, start_time, end_time FROM presence '
+            'WHERE user_id = ? ORDER BY day', (user_id,)
+        ))
+        return store.get(user_id)
+
+    def row_count(self):
+        """
+        Returns number of presence rows.
+        """
+        return self.query(
+            'SELECT SUM(days) FROM weekday_rollup'
+        ).fetchone()[0] or 0
+
+
+def _day_range(first, last):
+    """
+    Turns optional first and last dates into date ordinals.
+    """
+    return (
+        first.toordinal() if first is not None else ALL_DAYS[0],
+        last.toordinal() if last is not None else ALL_DAYS[1],
+    )
+
+
+class SQLitePresence(Mapping):
+    """
+    ``{user_id: UserPresence}`` view of an SQLiteBackend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getitem__(self, user_id):
+        presence = self.backend.user_presence(user_id)
+        if presence is None:
+            raise KeyError(user_id)
+        return presence
+
+    def __contains__(self, user_id):
+        return self.backend.has_user(user_id)
+
+    def __iter__(self):
+        return iter(self.backend.user_ids())
+
+    def __len__(self):
+        return len(self.backend.user_ids())
+
+    @property
+    def row_count(self):
+        """
+        Number of presence rows.
+        """
+        return self.backend.row_count()
+
+
+class SQLiteAggregates(SQLitePresence):
+    """
+    ``{user_id: UserAggregates}`` view of an SQLiteBackend.
+    """
+
+    def __getitem__(self, user_id):
+        if not self.backend.has_user(user_id):
+            raise KeyError(user_id)
+        return self.backend.user_aggregates(user_id)
+
+    def between(self, user_id, first=None, last=None):
+        """
+        Returns aggregates of user's presence within given dates.
+        """
+        return self.backend.user_aggregates(user_id, first, last)
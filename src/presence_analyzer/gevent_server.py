@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Cooperative serving with gevent.
+
+A single event loop serves all connections instead of a pool of
+threads. Blocking data access, like parsing DATA_CSV or the users
+file, is handed over to a small threadpool with offload(), so the loop
+keeps answering other requests meanwhile.
+
+The standard library has to be patched before Flask is imported, since
+Flask imports socket and ssl. So the gevent server runs in a process
+started with PATCH_ENVIRON set; the presence_analyzer package then
+calls patch() before it imports anything else.
+"""
+import os
+import thread
+
+try:
+    import gevent # pylint: disable=import-error
+    from gevent import monkey # pylint: disable=import-error
+    from gevent.pywsgi import WSGIServer # pylint: disable=import-error
+    from gevent.threadpool import ThreadPool # pylint: disable=import-error
+except ImportError:
+    gevent = None # pylint: disable=invalid-name
+
+# threadpool of the running server and ident of the thread of its loop
+EXECUTOR = {'POOL': None, 'LOOP': None}
+# environment variable of processes patched on import of presence_analyzer
+PATCH_ENVIRON = 'PRESENCE_ANALYZER_GEVENT'
+
+
+def available():
+    """
+    Checks if gevent is installed.
+    """
+    return gevent is not None
+
+
+def patch():
+    """
+    Makes sockets and blocking calls of the standard library cooperative.
+
+    Threading stays real, since parsing runs in the threadpool and takes
+    the data locks there.
+    """
+    monkey.patch_all(thread=False)
+
+
+def patch_from_environ():
+    """
+    Patches the standard library if the process is started with
+    PATCH_ENVIRON set.
+    """
+    if os.environ.get(PATCH_ENVIRON) and available() and not patched():
+        patch()
+
+
+def patched():
+    """
+    Checks if the standard library is patched.
+    """
+    return available() and monkey.is_module_patched('socket')
+
+
+def offload(function, *args):
+    """
+    Calls function in the threadpool when called from the event loop,
+    directly otherwise.
+    """
+    pool = EXECUTOR['POOL']
+    if pool is None or thread.get_ident() != EXECUTOR['LOOP']:
+        return function(*args)
+    return pool.apply(function, args)
+
+
+def start_executor(threads=8):
+    """
+    Creates the threadpool used by offload() from the current thread.
+    """
+    EXECUTOR['POOL'] = ThreadPool(threads)
+    EXECUTOR['LOOP'] = thread.get_ident()
+    return EXECUTOR['POOL']
+
+
+def stop_executor():
+    """
+    Stops the threadpool, offload() calls functions directly again.
+    """
+    pool, EXECUTOR['POOL'] = EXECUTOR['POOL'], None
+    if pool is not None:
+        pool.kill()
+
+
+def serve(app, host, port, threads=8):
+    """
+    Serves app on given address until interrupted.
+
+    The standard library should already be patched, see patch(); if it
+    isn't, it gets patched here, too late for modules imported before.
+    """
+    if not patched():
+        patch()
+    start_executor(threads)
+    server = WSGIServer((host, int(port)), app)
+    try:
+        server.serve_forever()
+    finally:
+        stop_executor()
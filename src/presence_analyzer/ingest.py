@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of presence CSV exports.
+"""
+import csv
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from datetime import date, datetime
+
+from .aggregates import build_aggregates
+from .snapshot import load_snapshot, snapshot_path, write_snapshot
+from .store import PresenceStore, new_column
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# least number of seconds between snapshots written after tail loads
+SNAPSHOT_INTERVAL = 300
+
+
+def parse_date_strptime(value):
+    """
+    Parses YYYY-MM-DD date into its ordinal using datetime.strptime.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+
+
+def parse_time_strptime(value):
+    """
+    Parses HH:MM:SS time into seconds since midnight using strptime.
+    """
+    parsed = datetime.strptime(value, '%H:%M:%S')
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+
+def parse_date_fast(value):
+    """
+    Parses YYYY-MM-DD date into its ordinal by slicing fixed offsets.
+
+    Values not matching the fixed format are handed over to strptime,
+    so both parsers accept and reject the same input.
+    """
+    if (len(value) != 10 or value[4] != '-' or value[7] != '-' or
+            not (value[:4] + value[5:7] + value[8:]).isdigit()):
+        return parse_date_strptime(value)
+    return date(int(value[:4]), int(value[5:7]), int(value[8:])).toordinal()
+
+
+def parse_time_fast(value):
+    """
+    Parses HH:MM:SS time into seconds since midnight by slicing.
+    """
+    if (len(value) != 8 or value[2] != ':' or value[5] != ':' or
+            not (value[:2] + value[3:5] + value[6:]).isdigit()):
+        return parse_time_strptime(value)
+    hour, minute, second = int(value[:2]), int(value[3:5]), int(value[6:])
+    if hour > 23 or minute > 59 or second > 59:
+        return parse_time_strptime(value)
+    return hour * 3600 + minute * 60 + second
+
+
+PARSERS = {
+    'strptime': (parse_date_strptime, parse_time_strptime),
+    'fast': (parse_date_fast, parse_time_fast),
+}
+# smallest part of a file worth parsing in a separate process
+MIN_CHUNK_SIZE = 1024 * 1024
+
+
+def read_presence_rows(csvfile, parser='fast'):
+    """
+    Yields ``(user_id, date ordinal, start, end)`` tuples from CSV file,
+    start and end given in seconds since midnight.
+
+    ``parser`` is one of PARSERS keys. Header, footer and malformed
+    lines are skipped.
+    """
+    parse_date, parse_time = PARSERS[parser]
+    presence_reader = csv.reader(csvfile, delimiter=',')
+    for i, row in enumerate(presence_reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            yield (
+                int(row[0]),
+                parse_date(row[1]),
+                parse_time(row[2]),
+                parse_time(row[3]),
+            )
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+
+
+def chunk_ranges(csvfile, start, end, count):
+    """
+    Splits ``[start, end)`` bytes of file into at most ``count`` ranges
+    starting at line beginnings.
+    """
+    bounds = [start]
+    for i in xrange(1, count):
+        csvfile.seek(max(start + (end - start) * i // count, bounds[-1]))
+        if csvfile.tell() > start:
+            # move to the beginning of the next line
+            csvfile.seek(-1, os.SEEK_CUR)
+            csvfile.readline()
+        if bounds[-1] < csvfile.tell() < end:
+            bounds.append(csvfile.tell())
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def parse_chunk(task):
+    """
+    Parses ``(path, parser, start, end)`` byte range of CSV file into
+    four columns, returned as raw bytes to keep the transfer compact.
+    """
+    path, parser, start, end = task
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start)
+        lines = csvfile.read(end - start).splitlines(True)
+    columns = [new_column() for _ in xrange(4)]
+    appends = [column.append for column in columns]
+    for row in read_presence_rows(lines, parser):
+        for append, value in zip(appends, row):
+            append(value)
+    return [column.tostring() for column in columns]
+
+
+def read_parallel(path, parser, start, end, workers):
+    """
+    Parses ``[start, end)`` bytes of CSV file in a pool of ``workers``
+    processes and returns PresenceStore of all rows.
+
+    Chunks are concatenated in file order before the store is sorted,
+    so the later of duplicate rows wins like with the serial parser.
+    The pool is forked, so it is meant for single threaded processes
+    like the dataset publisher, not for the app serving requests.
+    """
+    with open(path, 'rb') as csvfile:
+        ranges = chunk_ranges(csvfile, start, end, workers)
+    pool = multiprocessing.Pool(min(workers, len(ranges)))
+    try:
+        chunks = pool.map(parse_chunk, [
+            (path, parser, chunk_start, chunk_end)
+            for chunk_start, chunk_end in ranges
+        ])
+    finally:
+        pool.close()
+        pool.join()
+    columns = [new_column() for _ in xrange(4)]
+    for chunk in chunks:
+        for column, data in zip(columns, chunk):
+            column.fromstring(data)
+    return PresenceStore.from_columns(*columns)
+
+
+def last_line_end(csvfile, start, end):
+    """
+    Returns position after the last newline in ``[start, end)`` bytes
+    of file, ``start`` if there is none.
+    """
+    position = end
+    while position > start:
+        size = min(64 * 1024, position - start)
+        csvfile.seek(position - size)
+        found = csvfile.read(size).rfind('\n')
+        if found != -1:
+            return position - size + found + 1
+        position -= size
+    return start
+
+
+class CSVLoader(object):
+    """
+    Keeps a PresenceStore in sync with an append-only CSV export.
+
+    The loader remembers the byte offset it has parsed up to and the
+    identity (device, inode, size, mtime) of the file. When rows get
+    appended only the new tail is parsed and merged into the store.
+    A truncated, rotated or rewritten file triggers a full reload.
+
+    ``aggregates`` index is kept in step with the store; after a tail
+    load only users with new rows get recomputed. ``background`` is set
+    when a refresher thread keeps the loader up to date.
+
+    With ``snapshot`` enabled a full reload first tries the binary
+    snapshot next to the CSV file. Every full parse writes a new one,
+    tail loads only once ``snapshot_interval`` seconds passed since the
+    last one, as writing it costs as much as the whole dataset.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = None
+        self.aggregates = {}
+        self.source = None
+        self.identity = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.version = 0
+        self.background = False
+        self.full_loads = 0
+        self.tail_loads = 0
+        self.snapshot_loads = 0
+        self.snapshot_interval = SNAPSHOT_INTERVAL
+        self.snapshot_time = 0
+
+    def load(self, path, parser='fast', snapshot=False, workers=1,
+             engine='auto'):
+        """
+        Returns up to date PresenceStore for given CSV file.
+
+        With more than one of ``workers`` big files are parsed in
+        parallel processes, see read_parallel(). ``engine`` is passed
+        to build_aggregates().
+        """
+        stat = os.stat(path)
+        with self.lock:
+            if (path, parser) != self.source or \
+                    (stat.st_dev, stat.st_ino) != self.identity or \
+                    stat.st_size < self.size or \
+                    (stat.st_size == self.size and
+                     stat.st_mtime != self.mtime):
+                if snapshot and self._load_snapshot(path, parser, stat):
+                    return self.store
+                self._read(
+                    path, parser, stat, PresenceStore.from_rows([]), 0,
+                    workers, engine
+                )
+                self.full_loads += 1
+                self.snapshot_time = 0
+            elif stat.st_size > self.size:
+                self._read(
+                    path, parser, stat, self.store, self.offset, workers,
+                    engine
+                )
+                self.tail_loads += 1
+            else:
+                return self.store
+            if snapshot and \
+                    time.time() - self.snapshot_time >= self.snapshot_interval:
+                self._write_snapshot(path)
+            return self.store
+
+    def _load_snapshot(self, path, parser, stat):
+        """
+        Takes data from snapshot made of the current CSV file, if any.
+        """
+        loaded = load_snapshot(
+            snapshot_path(path), stat.st_size, stat.st_mtime
+        )
+        if loaded is None:
+            return False
+        self.store, self.aggregates, self.offset = loaded
+        self.source = (path, parser)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.version += 1
+        self.snapshot_loads += 1
+        self.snapshot_time = time.time()
+        return True
+
+    def _write_snapshot(self, path):
+        """
+        Saves current data as snapshot of the CSV file.
+        """
+        self.snapshot_time = time.time()
+        try:
+            write_snapshot(
+                snapshot_path(path), self.store, self.aggregates,
+                self.size, self.mtime, self.offset
+            )
+        except (IOError, OSError):
+            log.warning('Cannot write snapshot of %s', path, exc_info=True)
+
+    def _read(self, path, parser, stat, store, offset, workers=1,
+              engine='auto'):
+        """
+        Parses file from ``offset`` on and merges new rows into ``store``.
+
+        A row of an unterminated line replaced the row of the same day
+        parsed before; if the completed line turns out malformed, that
+        earlier row is not brought back.
+        """
+        previous = self.aggregates if offset else None
+        changed = set()
+        if offset and self.size > offset:
+            # the unterminated last line parsed last time is read again
+            # below; its row goes first, so that a line completed into
+            # another row or into a malformed one doesn't leave it behind
+            with open(path, 'rb') as csvfile:
+                csvfile.seek(offset)
+                fragment = csvfile.read(self.size - offset)
+            keys = [row[:2] for row in read_presence_rows([fragment], parser)]
+            store = store.without(keys)
+            changed = set(user_id for user_id, _ in keys)
+            previous = dict(previous)
+            for user_id in changed:
+                previous.pop(user_id, None)
+        chunks = min(workers, (stat.st_size - offset) // MIN_CHUNK_SIZE)
+        if chunks > 1:
+            tail = read_parallel(path, parser, offset, stat.st_size, chunks)
+            with open(path, 'rb') as csvfile:
+                position = [
+                    last_line_end(csvfile, offset, stat.st_size),
+                    stat.st_size
+                ]
+        else:
+            position = [offset, offset]
+            with open(path, 'rb') as csvfile:
+                csvfile.seek(offset)
+                tail = PresenceStore.from_rows(read_presence_rows(
+                    _track_lines(csvfile, position), parser
+                ))
+        # an unterminated last line may still be incomplete, so the offset
+        # stays in front of it and it gets parsed again with the next tail
+        self.offset, self.size = position
+        store = store.merged(tail)
+        self.aggregates = build_aggregates(
+            store, set(tail.offsets) | (changed & set(store.offsets)),
+            previous, tail, engine
+        )
+        self.store = store
+        self.source = (path, parser)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.mtime = stat.st_mtime
+        self.version += 1
+
+
+def _track_lines(csvfile, position):
+    """
+    Yields lines of file, keeping ``position`` as [end of the last
+    complete line, end of data read].
+    """
+    for line in iter(csvfile.readline, ''):
+        position[1] += len(line)
+        if line.endswith('\n'):
+            position[0] = position[1]
+        yield line
+
+
+class DatasetPublisher(object):
+    """
+    Publishes presence data of a CSV file as a shared dataset file.
+
+    Meant to run in a single loader process; workers attach to the
+    published file with snapshot.SharedDataset.
+    """
+
+    def __init__(self, csv_path, shared_path, parser='fast', workers=1):
+        self.csv_path = csv_path
+        self.shared_path = shared_path
+        self.parser = parser
+        self.workers = workers
+        self.loader = CSVLoader()
+        self.published = None
+
+    def publish(self):
+        """
+        Writes new version of shared dataset if the CSV has changed.
+        """
+        loader = self.loader
+        loader.load(self.csv_path, self.parser, workers=self.workers)
+        if loader.version == self.published:
+            return False
+        write_snapshot(
+            self.shared_path, loader.store, loader.aggregates,
+            loader.size, loader.mtime, loader.offset
+        )
+        self.published = loader.version
+        return True
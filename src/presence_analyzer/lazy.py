@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy loading of presence data, user by user.
+
+On load only an index of byte ranges holding every user's lines is
+built; a user's history is parsed when it is first asked for and kept
+in a bounded LRU cache.
+"""
+import os
+import threading
+from array import array
+from collections import Mapping, OrderedDict
+
+from .aggregates import UserAggregates
+from .ingest import read_presence_rows
+from .store import PresenceStore
+
+# byte offsets, doubles where unsigned long has only 32 bits
+OFFSET_TYPECODE = 'L' if array('L').itemsize >= 8 else 'd'
+
+
+class LazyLoader(object):
+    """
+    Keeps an index of where each user's rows live in a CSV file.
+
+    ``index`` maps user ids to flat arrays of ``[start, end)`` byte
+    ranges; consecutive lines of a user share one range, so a file
+    sorted by user costs one range per user. Like CSVLoader appended
+    lines are indexed incrementally and a replaced file starts over.
+
+    ``store`` and ``aggregates`` map user ids to UserPresence and
+    UserAggregates parsed on demand; at most ``cache_size`` users are
+    kept, ``hits`` and ``misses`` count lookups of the cache.
+
+    Lines are indexed by their user id only, so ``rows`` counts
+    malformed lines too until their user gets parsed; a user without
+    a single valid line is dropped from the index then.
+    """
+
+    def __init__(self, cache_size=256):
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.index = {}
+        self.rows = 0
+        # numbers of malformed lines of parsed users
+        self.invalid = {}
+        # user id and start of indexed unterminated last line
+        self.pending = None
+        self.source = None
+        self.identity = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.version = 0
+        self.background = False
+        self.full_loads = 0
+        self.tail_loads = 0
+        self.hits = 0
+        self.misses = 0
+        self.store = LazyPresence(self)
+        self.aggregates = LazyAggregates(self)
+
+    def load(self, path, parser='fast', cache_size=None):
+        """
+        Brings index up to date with given CSV file and returns store.
+        """
+        stat = os.stat(path)
+        with self.lock:
+            if cache_size is not None:
+                self.cache_size = cache_size
+                self._trim()
+            if (path, parser) != self.source or \
+                    (stat.st_dev, stat.st_ino) != self.identity or \
+                    stat.st_size < self.size or \
+                    (stat.st_size == self.size and
+                     stat.st_mtime != self.mtime):
+                self.index = {}
+                self.rows = 0
+                self.invalid = {}
+                self.pending = None
+                self.cache.clear()
+                self.offset = 0
+                self.full_loads += 1
+            elif stat.st_size > self.size:
+                self.tail_loads += 1
+            else:
+                return self.store
+            self._index(path)
+            self.source = (path, parser)
+            self.identity = (stat.st_dev, stat.st_ino)
+            self.mtime = stat.st_mtime
+            self.version += 1
+            return self.store
+
+    def _index(self, path):
+        """
+        Indexes lines from ``offset`` on, forgetting cached users who
+        got new lines.
+        """
+        index = self.index
+        if self.pending is not None:
+            # the unterminated line is indexed again below
+            user_id, start = self.pending
+            ranges = index[user_id]
+            if ranges[-2] < start:
+                ranges[-1] = start
+            else:
+                del ranges[-2:]
+                if not ranges:
+                    del index[user_id]
+            self.rows -= 1
+            self.pending = None
+        position = self.offset
+        touched = set()
+        with open(path, 'rb') as csvfile:
+            csvfile.seek(position)
+            for line in iter(csvfile.readline, ''):
+                start, position = position, position + len(line)
+                user_id = _user_id(line)
+                if user_id is None:
+                    continue
+                ranges = index.get(user_id)
+                if ranges is None:
+                    ranges = index[user_id] = array(OFFSET_TYPECODE)
+                if ranges and ranges[-1] == start:
+                    ranges[-1] = position
+                else:
+                    ranges.extend((start, position))
+                self.rows += 1
+                touched.add(user_id)
+                if line.endswith('\n'):
+                    self.offset = position
+                else:
+                    self.pending = (user_id, start)
+        self.size = position
+        for user_id in touched:
+            self.cache.pop(user_id, None)
+
+    def _trim(self):
+        """
+        Evicts least recently used users above ``cache_size``.
+        """
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def user(self, user_id):
+        """
+        Returns ``(UserPresence, UserAggregates)`` of user.
+
+        Raises KeyError if user has no valid lines.
+        """
+        with self.lock:
+            entry = self.cache.pop(user_id, None)
+            if entry is not None:
+                self.cache[user_id] = entry
+                self.hits += 1
+                return entry
+            ranges = array(OFFSET_TYPECODE, self.index[user_id])
+            self.misses += 1
+            (path, parser), version = self.source, self.version
+        entry, invalid = _parse_user(path, parser, user_id, ranges)
+        with self.lock:
+            if self.version == version:
+                self.rows -= invalid - self.invalid.get(user_id, 0)
+                self.invalid[user_id] = invalid
+                if entry is None:
+                    self._drop(user_id)
+                else:
+                    self.cache[user_id] = entry
+                    self._trim()
+        if entry is None:
+            raise KeyError(user_id)
+        return entry
+
+    def _drop(self, user_id):
+        """
+        Forgets user whose indexed lines are all malformed.
+        """
+        del self.index[user_id]
+        del self.invalid[user_id]
+        if self.pending is not None and self.pending[0] == user_id:
+            # offset is still in front of it, so it is read again
+            self.pending = None
+
+
+def _user_id(line):
+    """
+    Returns user id a CSV line starts with, None for header, footer or
+    malformed lines.
+    """
+    try:
+        return int(line[:line.index(',')])
+    except ValueError:
+        return None
+
+
+def _parse_user(path, parser, user_id, ranges):
+    """
+    Parses user's lines at given byte ranges of CSV file.
+
+    Returns ``((UserPresence, UserAggregates), malformed lines)``,
+    the pair is None if none of the lines is valid.
+    """
+    chunks = []
+    with open(path, 'rb') as csvfile:
+        for i in xrange(0, len(ranges), 2):
+            csvfile.seek(int(ranges[i]))
+            chunks.append(csvfile.read(int(ranges[i + 1] - ranges[i])))
+    lines = [
+        line for line in ''.join(chunks).splitlines()
+        if _user_id(line) is not None
+    ]
+    store = PresenceStore.from_rows(
+        row for row in read_presence_rows(lines, parser) if row[0] == user_id
+    )
+    presence = store.get(user_id)
+    if presence is None:
+        return None, len(lines)
+    invalid = len(lines) - len(presence)
+    return (presence, UserAggregates.from_rows(presence.rows())), invalid
+
+
+class LazyPresence(Mapping):
+    """
+    ``{user_id: UserPresence}`` view of a LazyLoader.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getitem__(self, user_id):
+        return self.loader.user(user_id)[0]
+
+    def __contains__(self, user_id):
+        return user_id in self.loader.index
+
+    def __iter__(self):
+        return iter(sorted(self.loader.index.keys()))
+
+    def __len__(self):
+        return len(self.loader.index)
+
+    @property
+    def row_count(self):
+        """
+        Number of indexed lines.
+        """
+        return self.loader.rows
+
+
+class LazyAggregates(LazyPresence):
+    """
+    ``{user_id: UserAggregates}`` view of a LazyLoader.
+    """
+
+    def __getitem__(self, user_id):
+        return self.loader.user(user_id)[1]
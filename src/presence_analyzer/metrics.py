@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms exposed in Prometheus text format.
+
+Nothing is recorded unless METRICS_ENABLED is set; then instrumented
+code pays a single config lookup per call.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request # pylint: disable=F0401
+
+from .main import app
+
+LOCK = threading.Lock()
+REGISTRY = OrderedDict()
+# latency buckets in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def enabled():
+    """
+    Checks if metrics are recorded.
+    """
+    return app.config.get('METRICS_ENABLED', False)
+
+
+def _format_labels(names, values, extra=''):
+    """
+    Formats label set like ``{function="get_data"}``.
+    """
+    pairs = [
+        '{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    """
+    Monotonic counter with labels.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+        REGISTRY[name] = self
+
+    def inc(self, values=(), amount=1):
+        """
+        Increments counter of given label values.
+        """
+        with LOCK:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def samples(self):
+        """
+        Yields ``(name, labels, value)`` of every series.
+        """
+        for values, value in sorted(self.series.iteritems()):
+            yield self.name, _format_labels(self.labels, values), value
+
+
+class Histogram(Counter):
+    """
+    Histogram of durations in seconds, with labels.
+    """
+    kind = 'histogram'
+
+    def observe(self, values, seconds):
+        """
+        Records one duration.
+        """
+        with LOCK:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def samples(self):
+        for values, series in sorted(self.series.iteritems()):
+            for bound, count in zip(BUCKETS, series):
+                yield self.name + '_bucket', _format_labels(
+                    self.labels, values, 'le="{0}"'.format(bound)
+                ), count
+            yield self.name + '_bucket', _format_labels(
+                self.labels, values, 'le="+Inf"'
+            ), series[-1]
+            yield self.name + '_sum', _format_labels(
+                self.labels, values
+            ), series[-2]
+            yield self.name + '_count', _format_labels(
+                self.labels, values
+            ), series[-1]
+
+
+FUNCTION_SECONDS = Histogram(
+    'presence_function_duration_seconds',
+    'Time spent in instrumented functions.',
+    ('function',)
+)
+REQUEST_SECONDS = Histogram(
+    'presence_request_duration_seconds',
+    'Time spent handling requests.',
+    ('endpoint', 'status')
+)
+CACHE_REQUESTS = Counter(
+    'presence_cache_requests_total',
+    'Lookups of cached functions.',
+    ('function', 'result')
+)
+
+
+def timed(function):
+    """
+    Records duration of every call of decorated function.
+    """
+    label = (function.__name__,)
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        if not enabled():
+            return function(*args, **kwargs)
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            FUNCTION_SECONDS.observe(label, time.time() - started)
+    return wrapper
+
+
+def count_cache(function_name, result):
+    """
+    Counts lookup of cached function, ``result`` is "hit", "miss"
+    or "stale".
+    """
+    if enabled():
+        CACHE_REQUESTS.inc((function_name, result))
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Remembers when request handling started.
+    """
+    if enabled():
+        g.metrics_started = time.time()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records duration of the request by endpoint and status code.
+    """
+    started = getattr(g, 'metrics_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(
+            (request.endpoint, response.status_code), time.time() - started
+        )
+    return response
+
+
+def render(gauges=()):
+    """
+    Renders all metrics and given ``(name, description, value)`` gauges
+    in Prometheus text format.
+    """
+    lines = []
+    for name, description, value in gauges:
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} gauge'.format(name))
+        lines.append('{0} {1}'.format(name, value))
+    with LOCK:
+        for metric in REGISTRY.itervalues():
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, metric.description
+            ))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, labels, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-request profiling.
+
+With PROFILING_ENABLED set, a request carrying the ``X-Profile`` header
+or the ``_profile`` query argument is run under cProfile. The stats are
+dumped to PROFILE_DIR when it is set and the file is named in the
+``X-Profile-File`` response header, otherwise the slowest functions are
+summarized in the ``X-Profile-Summary`` response header. Without the
+option no hooks are installed at all.
+"""
+import cProfile
+import os
+import pstats
+import time
+
+from flask import current_app, g, request # pylint: disable=F0401
+
+# functions listed in the summary header
+SUMMARY_SIZE = 5
+
+
+def install_profiler(app):
+    """
+    Installs profiling hooks if PROFILING_ENABLED is set.
+
+    Returns True when installed.
+    """
+    if not app.config.get('PROFILING_ENABLED', False):
+        return False
+    app.before_request(start_profiler)
+    app.after_request(stop_profiler)
+    app.teardown_request(discard_profiler)
+    return True
+
+
+def profile_requested():
+    """
+    Checks if the current request asks to be profiled.
+    """
+    return 'X-Profile' in request.headers or '_profile' in request.args
+
+
+def start_profiler():
+    """
+    Starts profiling the current request if it asks for it.
+    """
+    if profile_requested():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def stop_profiler(response):
+    """
+    Stops profiling and attaches the results to the response.
+
+    Streamed responses are profiled only until the view returns.
+    """
+    profiler = getattr(g, 'profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    g.profiler = None
+    directory = current_app.config.get('PROFILE_DIR')
+    if directory:
+        name = '{0}-{1:.6f}.prof'.format(request.endpoint, time.time())
+        profiler.dump_stats(os.path.join(directory, name))
+        response.headers['X-Profile-File'] = name
+    else:
+        response.headers['X-Profile-Summary'] = summarize(profiler)
+    return response
+
+
+def discard_profiler(exception=None): # pylint: disable=unused-argument
+    """
+    Stops profiling a request that failed before stop_profiler() ran,
+    so the profiler doesn't stay on for later requests of the thread.
+    """
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        g.profiler = None
+
+
+def summarize(profiler, size=SUMMARY_SIZE):
+    """
+    Returns one line summary of the ``size`` functions with the highest
+    cumulative time, like ``total=1.2ms; get_data (utils.py:153)=0.8ms``.
+    """
+    stats = pstats.Stats(profiler).stats
+    total = sum(inline for _, _, inline, _, _ in stats.itervalues())
+    slowest = sorted(
+        stats.iteritems(), key=lambda item: item[1][3], reverse=True
+    )[:size]
+    parts = ['total={0:.1f}ms'.format(total * 1e3)]
+    for (path, line, name), (_, _, _, cumulative, _) in slowest:
+        parts.append('{0} ({1}:{2})={3:.1f}ms'.format(
+            name, os.path.basename(path), line, cumulative * 1e3
+        ))
+    return '; '.join(parts)
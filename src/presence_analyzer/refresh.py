@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Background refreshing of presence and user data.
+"""
+import logging
+import threading
+import time
+
+from . import utils
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class Refresher(threading.Thread):
+    """
+    Daemon thread reloading DATA_CSV and DATA_USERS_XML every
+    ``interval`` seconds.
+
+    CSVLoader only parses the file when it has changed, so a short
+    interval is cheap. Request threads keep using the previous data
+    until the new one is swapped in.
+    """
+
+    def __init__(self, interval):
+        super(Refresher, self).__init__(name='presence-refresher')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.status = {
+            'interval': interval,
+            'runs': 0,
+            'errors': 0,
+            'last_run': None,
+            'last_duration': None,
+            'last_error': None,
+        }
+
+    def refresh(self):
+        """
+        Reloads data once, recording the outcome in ``status``.
+        """
+        started = time.time()
+        try:
+            utils.refresh_data()
+        except Exception as error: # pylint: disable=broad-except
+            log.exception('Refreshing presence data failed')
+            self.status['errors'] += 1
+            self.status['last_error'] = repr(error)
+        self.status['runs'] += 1
+        self.status['last_run'] = started
+        self.status['last_duration'] = time.time() - started
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        """
+        Stops the thread after the current refresh.
+        """
+        self.stopped.set()
+        utils.current_loader().background = False
+
+
+def start_refresher(app):
+    """
+    Starts background refresher if REFRESH_INTERVAL is configured.
+
+    Data is loaded once up front, so no request has to wait for it.
+    """
+    interval = app.config.get('REFRESH_INTERVAL', 0)
+    if not interval or 'presence_refresher' in app.extensions:
+        return app.extensions.get('presence_refresher')
+    refresher = Refresher(interval)
+    refresher.refresh()
+    utils.current_loader().background = True
+    refresher.start()
+    app.extensions['presence_refresher'] = refresher
+    return refresher
+
+
+def refresher_status(app):
+    """
+    Returns status of the background refresher or None if it is disabled.
+    """
+    refresher = app.extensions.get('presence_refresher')
+    if refresher is None:
+        return None
+    return dict(refresher.status, alive=refresher.is_alive())
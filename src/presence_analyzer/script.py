@@ -4,6 +4,8 @@
 
 import os
 import sys
+import time
+from ConfigParser import RawConfigParser
 from functools import partial
 
 import paste.script.command
@@ -29,8 +31,12 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.profiling import install_profiler
+    from presence_analyzer.refresh import start_refresher
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    install_profiler(app)
+    start_refresher(app)
     return app
 
 
@@ -59,6 +65,46 @@ def update_user_data():
         xml_user_file.close()
 
 
+def publish_dataset(interval=0):
+    """Publish SHARED_DATASET built of DATA_CSV, every N seconds if set."""
+    from presence_analyzer import app
+    from presence_analyzer.ingest import DatasetPublisher
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    publisher = DatasetPublisher(
+        app.config['DATA_CSV'],
+        app.config['SHARED_DATASET'],
+        app.config.get('DATA_CSV_PARSER', 'fast'),
+        app.config.get('DATA_CSV_WORKERS', 1),
+    )
+    while True:
+        if publisher.publish():
+            print 'Published version %d of %s' % (
+                publisher.published, publisher.shared_path
+            )
+        if not interval:
+            return
+        time.sleep(interval)
+
+
+def sync_database(interval=0):
+    """Import DATA_CSV into DATA_SQLITE, every N seconds if set."""
+    from presence_analyzer import app
+    from presence_analyzer import database
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    while True:
+        if database.sync_database(
+            app.config['DATA_CSV'],
+            app.config['DATA_SQLITE'],
+            app.config.get('DATA_CSV_PARSER', 'fast'),
+        ):
+            print 'Synced %s into %s' % (
+                app.config['DATA_CSV'], app.config['DATA_SQLITE']
+            )
+        if not interval:
+            return
+        time.sleep(interval)
+
+
 def _serve(action, debug=False, dry_run=False):
     """Build paster command from 'action' and 'debug' flag."""
     if debug:
@@ -87,12 +133,33 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _serve_gevent(dry_run=False):
+    """Serve the application with gevent on the deploy.ini address."""
+    from presence_analyzer import gevent_server
+    if not gevent_server.available():
+        sys.exit('gevent is not installed')
+    ini = RawConfigParser()
+    ini.read(abspath(DEPLOY_INI))
+    host, port = ini.get('server:main', 'host'), ini.get('server:main', 'port')
+    print 'gevent serving on %s:%s' % (host, port)
+    if dry_run:
+        return
+    if not gevent_server.patched():
+        # Flask is imported already, start over patched from the beginning
+        os.environ[gevent_server.PATCH_ENVIRON] = '1'
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    app = make_app()
+    gevent_server.serve(
+        app, host, port, app.config.get('GEVENT_THREADPOOL_SIZE', 8)
+    )
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|status] [--server=gevent]
+    def action_serve(action=('a', 'start'), dry_run=False, server='paste'):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -101,8 +168,13 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--server' is 'paste' (threadpool) or 'gevent' (event loop,
+           runs in foreground only)
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        if server == 'gevent':
+            _serve_gevent(dry_run=dry_run)
+        else:
+            _serve(action, debug=False, dry_run=dry_run)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -119,4 +191,22 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl publish [--interval=N]
+    def action_publish(interval=0):
+        """Publish the shared dataset used by workers.
+
+        Builds SHARED_DATASET from DATA_CSV once or, with '--interval',
+        keeps republishing it when the CSV changes.
+        """
+        publish_dataset(interval)
+
+    # bin/flask-ctl sync [--interval=N]
+    def action_sync(interval=0):
+        """Import presence data into the SQLite database.
+
+        Brings DATA_SQLITE up to date with DATA_CSV once or, with
+        '--interval', keeps syncing new rows every N seconds.
+        """
+        sync_database(interval)
+
     werkzeug.script.run()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+JSON serializer backends.
+"""
+import json
+import zlib
+from collections import OrderedDict
+from functools import partial
+
+try:
+    import ujson # pylint: disable=import-error
+except ImportError:
+    ujson = None # pylint: disable=invalid-name
+
+try:
+    import simplejson # pylint: disable=import-error
+except ImportError:
+    simplejson = None # pylint: disable=invalid-name
+
+# installed backends giving the same output as the standard library;
+# stdlib json has C speedups and beats simplejson on our responses, so
+# it is the default
+JSON_BACKENDS = OrderedDict()
+JSON_BACKENDS['json'] = json.dumps
+if simplejson is not None:
+    JSON_BACKENDS['simplejson'] = simplejson.dumps
+
+# backends rounding floats, used only when chosen explicitly; ujson
+# keeps at most 15 significant digits even with double_precision=17
+LOSSY_JSON_BACKENDS = OrderedDict()
+if ujson is not None:
+    LOSSY_JSON_BACKENDS['ujson'] = partial(
+        ujson.dumps, escape_forward_slashes=False, double_precision=17
+    )
+
+
+def get_dumps(backend='auto'):
+    """
+    Returns dumps function of given backend.
+
+    "auto" is the standard library json, a lossy backend has to be
+    named; unknown or not installed backends fall back to the standard
+    library too.
+    """
+    if backend == 'auto':
+        return json.dumps
+    if backend in LOSSY_JSON_BACKENDS:
+        return LOSSY_JSON_BACKENDS[backend]
+    return JSON_BACKENDS.get(backend, json.dumps)
+
+
+def gzip_compress(data, level=6):
+    """
+    Compresses data into gzip format.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+A snapshot keeps the four store columns and the aggregate index as
+raw machine integers, keyed by size and mtime of the CSV file it was
+parsed from. Loading maps the file into memory; with NumPy the columns
+are used in place, so forked workers share the same pages.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import Mapping
+
+try:
+    import numpy  # pylint: disable=import-error
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+
+from .aggregates import UserAggregates
+from .store import PresenceStore, TYPECODE, new_column
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESNAP\0'
+FORMAT_VERSION = 3
+# magic, format version, byte order, item size, source size, source mtime,
+# parsed offset, rows, users with aggregates, their months
+HEADER = struct.Struct('<8sIcBqdqqqq')
+# UserAggregates sums kept per user, followed by last_day
+SUMS = (
+    ('counts', 7), ('intervals', 7), ('starts', 7), ('ends', 7),
+    ('month_hours', 12), ('month_years', 12),
+)
+ROW_SIZE = sum(size for _, size in SUMS) + 1
+HEADER_SIZE = 64
+BYTE_ORDER = 'l' if sys.byteorder == 'little' else 'b'
+
+
+def snapshot_path(path):
+    """
+    Returns path of the snapshot kept next to given CSV file.
+    """
+    return path + '.snapshot'
+
+
+def write_snapshot(path, store, aggregates, size, mtime, offset):
+    """
+    Writes snapshot of store and aggregates parsed from ``size`` bytes
+    of CSV file modified at ``mtime``, up to line ending at ``offset``.
+
+    The file is written aside and renamed into place, so readers never
+    see a partial snapshot.
+    """
+    index = _aggregate_columns(aggregates)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(
+            MAGIC, FORMAT_VERSION, BYTE_ORDER, array(TYPECODE).itemsize,
+            size, mtime, offset, store.row_count, len(index[0]),
+            len(index[3])
+        ).ljust(HEADER_SIZE, '\0'))
+        for column in (store.user_ids, store.dates, store.starts, store.ends):
+            snapshot.write(column.tostring())
+        for column in index:
+            snapshot.write(column.tostring())
+    os.rename(tmp_path, path)
+
+
+def _aggregate_columns(aggregates):
+    """
+    Flattens ``{user_id: UserAggregates}`` index into columns read by
+    MappedAggregates.
+    """
+    user_ids, sums, month_offsets, month_keys, month_days, month_hours = [
+        new_column() for _ in xrange(6)
+    ]
+    month_offsets.append(0)
+    for user_id in sorted(aggregates):
+        user_aggregates = aggregates[user_id]
+        user_ids.append(user_id)
+        for name, _ in SUMS:
+            sums.extend(getattr(user_aggregates, name))
+        sums.append(user_aggregates.last_day or 0)
+        for (year, month), (days, hours) in \
+                sorted(user_aggregates.months.iteritems()):
+            month_keys.append(year * 12 + month - 1)
+            month_days.append(days)
+            month_hours.append(hours)
+        month_offsets.append(len(month_keys))
+    return user_ids, sums, month_offsets, month_keys, month_days, month_hours
+
+
+def load_snapshot(path, size=None, mtime=None):
+    """
+    Loads ``(store, aggregates, offset)`` from snapshot file.
+
+    Returns None when there is no snapshot, it has other format or it
+    was made of a different version (``size``, ``mtime``) of the CSV.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            mapped = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_READ
+            )
+    except (IOError, OSError, ValueError):
+        return None
+    if len(mapped) < HEADER_SIZE:
+        return None
+    (magic, version, byte_order, itemsize, source_size, source_mtime,
+     offset, rows, users, months) = HEADER.unpack_from(mapped)
+    if (magic, version, byte_order, itemsize) != \
+            (MAGIC, FORMAT_VERSION, BYTE_ORDER, array(TYPECODE).itemsize):
+        log.info('Ignoring snapshot %s of other format', path)
+        return None
+    if size is not None and (source_size, source_mtime) != (size, mtime):
+        return None
+    counts = [rows] * 4 + [users, users * ROW_SIZE, users + 1] + [months] * 3
+    if len(mapped) != HEADER_SIZE + sum(counts) * itemsize:
+        log.info('Ignoring truncated snapshot %s', path)
+        return None
+    columns = []
+    position = HEADER_SIZE
+    for count in counts:
+        columns.append(_column(mapped, position, count))
+        position += count * itemsize
+    return (
+        PresenceStore(*columns[:4]), MappedAggregates(*columns[4:]), offset
+    )
+
+
+class MappedAggregates(Mapping):
+    """
+    ``{user_id: UserAggregates}`` index kept in columns of a snapshot.
+
+    ``sums`` holds ROW_SIZE integers of every one of sorted
+    ``user_ids``; their ``months`` are ``month_keys`` (months since
+    year 0), ``month_days`` and ``month_hours`` between consecutive
+    ``month_offsets``. Workers attached to the same snapshot share
+    the columns, UserAggregates are built from them on access.
+    """
+
+    def __init__(self, user_ids, sums, month_offsets, month_keys,
+                 month_days, month_hours):
+        self.user_ids = user_ids
+        self.sums = sums
+        self.month_offsets = month_offsets
+        self.month_keys = month_keys
+        self.month_days = month_days
+        self.month_hours = month_hours
+
+    def _position(self, user_id):
+        """
+        Returns position of user in ``user_ids``, raises KeyError if
+        there is none.
+        """
+        i = bisect.bisect_left(self.user_ids, user_id)
+        if i == len(self.user_ids) or self.user_ids[i] != user_id:
+            raise KeyError(user_id)
+        return i
+
+    def __getitem__(self, user_id):
+        i = self._position(user_id)
+        row = self.sums[i * ROW_SIZE:(i + 1) * ROW_SIZE].tolist()
+        aggregates = UserAggregates()
+        start = 0
+        for name, size in SUMS:
+            setattr(aggregates, name, row[start:start + size])
+            start += size
+        aggregates.last_day = row[start] or None
+        lo, hi = int(self.month_offsets[i]), int(self.month_offsets[i + 1])
+        for key, days, hours in zip(
+                self.month_keys[lo:hi].tolist(),
+                self.month_days[lo:hi].tolist(),
+                self.month_hours[lo:hi].tolist()):
+            aggregates.months[key // 12, key % 12 + 1] = [days, hours]
+        return aggregates
+
+    def __contains__(self, user_id):
+        try:
+            self._position(user_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.user_ids.tolist())
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+class SharedDataset(object):
+    """
+    Read-only dataset attached from a snapshot file published by
+    a separate loader process, see ingest.DatasetPublisher.
+
+    Every worker maps the same file; a new version is published by
+    renaming it into place, which the next load notices by inode
+    and mtime and attaches to.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = None
+        self.aggregates = {}
+        self.identity = None
+        self.mtime = None
+        self.version = 0
+        self.background = False
+        self.attaches = 0
+
+    def load(self, path):
+        """
+        Returns PresenceStore of the currently published dataset.
+        """
+        stat = os.stat(path)
+        identity = (path, stat.st_dev, stat.st_ino, stat.st_mtime)
+        with self.lock:
+            if identity != self.identity:
+                loaded = load_snapshot(path)
+                if loaded is None:
+                    raise IOError('Invalid shared dataset {0}'.format(path))
+                self.store, self.aggregates, _ = loaded
+                self.identity = identity
+                self.mtime = stat.st_mtime
+                self.version += 1
+                self.attaches += 1
+            return self.store
+
+
+def _column(mapped, position, rows):
+    """
+    Returns column of ``rows`` integers mapped at ``position``.
+
+    Without NumPy the column has to be copied into an array.
+    """
+    if numpy is not None:
+        if not rows:
+            return numpy.zeros(0, dtype=numpy.dtype(TYPECODE))
+        return numpy.frombuffer(
+            mapped, dtype=numpy.dtype(TYPECODE), count=rows, offset=position
+        )
+    column = new_column()
+    column.fromstring(mapped[position:position + rows * column.itemsize])
+    return column
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, columnar storage of presence data.
+"""
+import bisect
+from array import array
+from collections import Mapping
+from datetime import date, time
+
+# 32-bit signed integers are enough for user ids, date ordinals
+# and seconds since midnight.
+TYPECODE = 'i'
+
+
+def new_column(values=()):
+    """
+    Creates an empty (or prefilled) column for the presence store.
+    """
+    return array(TYPECODE, values)
+
+
+def as_column(values):
+    """
+    Returns ``values`` as a column, copying other sequences (like NumPy
+    arrays mapped from a snapshot) into a new array.
+    """
+    if isinstance(values, array):
+        return values
+    column = new_column()
+    column.fromstring(values.tostring())
+    return column
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class UserPresence(Mapping):
+    """
+    Read-only view of a single user's rows in a PresenceStore.
+
+    Behaves like ``{datetime.date: {'start': time, 'end': time}}``
+    ordered by date, without materializing any of the entries.
+    """
+
+    def __init__(self, store, lo, hi):
+        self.store = store
+        self.lo = lo
+        self.hi = hi
+
+    def _position(self, day):
+        """
+        Returns row index of given date or raises KeyError.
+        """
+        try:
+            ordinal = day.toordinal()
+        except AttributeError:
+            raise KeyError(day)
+        dates = self.store.dates
+        i = bisect.bisect_left(dates, ordinal, self.lo, self.hi)
+        if i == self.hi or dates[i] != ordinal:
+            raise KeyError(day)
+        return i
+
+    def __getitem__(self, day):
+        i = self._position(day)
+        return {
+            'start': seconds_to_time(self.store.starts[i]),
+            'end': seconds_to_time(self.store.ends[i]),
+        }
+
+    def __contains__(self, day):
+        try:
+            self._position(day)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        dates = self.store.dates
+        for i in xrange(self.lo, self.hi):
+            yield date.fromordinal(dates[i])
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def iteritems(self):
+        store = self.store
+        for i in xrange(self.lo, self.hi):
+            yield date.fromordinal(store.dates[i]), {
+                'start': seconds_to_time(store.starts[i]),
+                'end': seconds_to_time(store.ends[i]),
+            }
+
+    def items(self):
+        return list(self.iteritems())
+
+    def between(self, first=None, last=None):
+        """
+        Returns view of rows from ``first`` to ``last`` date inclusive.
+
+        Either bound may be None. Finding the range costs two binary
+        searches, no rows are copied.
+        """
+        dates = self.store.dates
+        lo, hi = self.lo, self.hi
+        if first is not None:
+            lo = bisect.bisect_left(dates, first.toordinal(), lo, hi)
+        if last is not None:
+            hi = bisect.bisect_right(dates, last.toordinal(), lo, hi)
+        return UserPresence(self.store, lo, hi)
+
+    def rows(self):
+        """
+        Iterates over raw ``(date ordinal, start, end)`` tuples,
+        start and end given in seconds since midnight.
+        """
+        store = self.store
+        return zip(
+            store.dates[self.lo:self.hi].tolist(),
+            store.starts[self.lo:self.hi].tolist(),
+            store.ends[self.lo:self.hi].tolist(),
+        )
+
+
+class PresenceStore(Mapping):
+    """
+    Presence data kept in four parallel columns sorted by user and date.
+
+    Columns hold user ids, date ordinals and start/end times in seconds
+    since midnight, either as arrays or as NumPy arrays mapped from
+    a snapshot. ``offsets`` maps every user id to the ``(lo, hi)``
+    range of their rows, so ``store[user_id]`` is a cheap view that
+    behaves like the nested dict returned by ``get_data()`` before.
+    """
+
+    def __init__(self, user_ids, dates, starts, ends):
+        self.user_ids = user_ids
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        self.offsets = {}
+        lo = 0
+        while lo < len(user_ids):
+            hi = bisect.bisect_right(user_ids, user_ids[lo], lo)
+            self.offsets[int(user_ids[lo])] = (lo, hi)
+            lo = hi
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the store from ``(user_id, date ordinal, start, end)`` rows.
+
+        Rows may come in any order. When a user has more than one row
+        for the same date, the last one wins.
+        """
+        user_ids, dates, starts, ends = [new_column() for _ in xrange(4)]
+        for user_id, ordinal, start, end in rows:
+            user_ids.append(user_id)
+            dates.append(ordinal)
+            starts.append(start)
+            ends.append(end)
+        return cls.from_columns(user_ids, dates, starts, ends)
+
+    @classmethod
+    def from_columns(cls, user_ids, dates, starts, ends):
+        """
+        Builds the store from unsorted columns, later rows win.
+        """
+        if _is_sorted_unique(user_ids, dates):
+            return cls(user_ids, dates, starts, ends)
+
+        order = sorted(
+            xrange(len(dates)),
+            key=lambda i: (user_ids[i], dates[i])
+        )
+        # keep only the last of every (user_id, date) run; sorted() is
+        # stable, so the last one comes from the latest row
+        keep = [
+            i for pos, i in enumerate(order)
+            if pos + 1 == len(order) or
+            (user_ids[i], dates[i]) !=
+            (user_ids[order[pos + 1]], dates[order[pos + 1]])
+        ]
+        return cls(*[
+            new_column(column[i] for i in keep)
+            for column in (user_ids, dates, starts, ends)
+        ])
+
+    def merged(self, other):
+        """
+        Returns a new store with rows of both stores.
+
+        Rows of ``other`` win over rows of this store with the same user
+        and date. Users untouched by ``other`` are copied in bulk, so
+        merging a small tail of new rows costs little more than a copy.
+        """
+        if not other.row_count:
+            return self
+        source = tuple(
+            as_column(column)
+            for column in (self.user_ids, self.dates, self.starts, self.ends)
+        )
+        update = (other.user_ids, other.dates, other.starts, other.ends)
+        columns = [new_column() for _ in xrange(4)]
+        pos = 0
+        for user_id in sorted(other.offsets):
+            olo, ohi = other.offsets[user_id]
+            lo, hi = self.offsets.get(user_id, (None, None))
+            if lo is None:
+                lo = hi = bisect.bisect_left(self.user_ids, user_id, pos)
+            for column, values in zip(columns, source):
+                column.extend(values[pos:lo])
+            pos = hi
+            if lo == hi or source[1][hi - 1] < other.dates[olo]:
+                # new rows come after the existing ones
+                for column, old, new in zip(columns, source, update):
+                    column.extend(old[lo:hi])
+                    column.extend(new[olo:ohi])
+                continue
+            rows = dict(
+                (source[1][i], (source[2][i], source[3][i]))
+                for i in xrange(lo, hi)
+            )
+            rows.update(
+                (other.dates[i], (other.starts[i], other.ends[i]))
+                for i in xrange(olo, ohi)
+            )
+            for ordinal in sorted(rows):
+                columns[0].append(user_id)
+                columns[1].append(ordinal)
+                columns[2].append(rows[ordinal][0])
+                columns[3].append(rows[ordinal][1])
+        for column, values in zip(columns, source):
+            column.extend(values[pos:])
+        return self.__class__(*columns)
+
+    def without(self, keys):
+        """
+        Returns a new store without rows of given ``(user_id, date
+        ordinal)`` keys, this one if it has none of them.
+        """
+        drop = set()
+        for user_id, ordinal in keys:
+            lo, hi = self.offsets.get(user_id, (0, 0))
+            i = bisect.bisect_left(self.dates, ordinal, lo, hi)
+            if i < hi and self.dates[i] == ordinal:
+                drop.add(i)
+        if not drop:
+            return self
+        source = tuple(
+            as_column(column)
+            for column in (self.user_ids, self.dates, self.starts, self.ends)
+        )
+        columns = [new_column() for _ in xrange(4)]
+        pos = 0
+        for i in sorted(drop) + [len(self.dates)]:
+            for column, values in zip(columns, source):
+                column.extend(values[pos:i])
+            pos = i + 1
+        return self.__class__(*columns)
+
+    def __getitem__(self, user_id):
+        lo, hi = self.offsets[user_id]
+        return UserPresence(self, lo, hi)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def row_count(self):
+        """
+        Number of stored presence rows.
+        """
+        return len(self.dates)
+
+    def memory_size(self):
+        """
+        Approximate amount of bytes taken by the columns.
+        """
+        return sum(
+            column.itemsize * len(column)
+            for column in (self.user_ids, self.dates, self.starts, self.ends)
+        )
+
+
+def _is_sorted_unique(user_ids, dates):
+    """
+    Checks if columns are strictly ordered by (user_id, date).
+    """
+    for i in xrange(1, len(dates)):
+        if (user_ids[i - 1], dates[i - 1]) >= (user_ids[i], dates[i]):
+            return False
+    return True
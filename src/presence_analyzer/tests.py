@@ -4,23 +4,55 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import collections
 import datetime
+import gzip
 import json
+import os
 import os.path
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from presence_analyzer import aggregates
+from presence_analyzer import database
+from presence_analyzer import gevent_server
+from presence_analyzer import ingest
+from presence_analyzer import lazy
 from presence_analyzer import main
+from presence_analyzer import metrics
+from presence_analyzer import profiling
+from presence_analyzer import refresh
+from presence_analyzer import serializers
+from presence_analyzer import snapshot
+from presence_analyzer import store
+from presence_analyzer import vectorized
 from presence_analyzer import utils
+from presence_analyzer import views
 from presence_analyzer.helpers import func
+from werkzeug.http import http_date
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..',
     'runtime', 'data', 'test_data.csv'
 )
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..',
+    'runtime', 'data', 'sample_data.csv'
+)
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..',
     'runtime', 'data', 'sample_users.xml'
 )
+USERS_XML = os.path.join(
+    os.path.dirname(__file__), '..', '..',
+    'runtime', 'data', 'users.xml'
+)
 
 
 # pylint: disable=maybe-no-member, too-many-public-methods
@@ -60,10 +92,573 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
-        self.assertDictEqual(data['10'], {
+        self.assertDictEqual(data[0], {
+            'id': 10,
             'image': 'https://intranet.stxnext.pl:443/api/images/users/141',
             'name': 'Adam P.'
         })
+        self.assertEqual(data[1]['name'], 'Adrian K.')
+
+    def test_api_users_etag(self):
+        """
+        Test if unchanged users listing is answered with 304.
+        """
+        resp = self.client.get('/api/v1/users')
+        etag = resp.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-None-Match': '"other"'}
+        )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_conditional(self):
+        """
+        Test if statistics of unchanged data are answered with 304.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        main.app.config['DATA_CSV'] = path
+        url = '/api/v1/presence_weekday/10'
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(
+            self.client.get('/api/v1/mean_time_weekday/11').headers['ETag'],
+            etag
+        )
+
+        calls = []
+        get_user_aggregates = views.get_user_aggregates
+
+        def counted(*args):
+            """
+            Counts computations of statistics.
+            """
+            calls.append(args)
+            return get_user_aggregates(*args)
+
+        views.get_user_aggregates = counted
+        self.addCleanup(
+            setattr, views, 'get_user_aggregates', get_user_aggregates
+        )
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+        resp = self.client.get(
+            url, headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(calls, [])
+        resp = self.client.get(url, headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(calls), 1)
+
+        with open(path, 'ab') as csvfile:
+            csvfile.write(b'10,2013-09-13,09:00:00,17:00:00\n')
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        etag = self.client.get('/api/v1/groups').headers['ETag']
+        resp = self.client.get(
+            '/api/v1/groups', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get('/api/v1/export/rows')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('ETag', resp.headers)
+
+    def test_api_conditional_same_second(self):
+        """
+        Test if data changed within the second of the last change isn't
+        answered with 304 to If-Modified-Since.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        # a second that is not over yet
+        second = int(time.time()) + 5
+        os.utime(path, (second + 0.1, second + 0.1))
+        main.app.config['DATA_CSV'] = path
+        url = '/api/v1/presence_weekday/10'
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Last-Modified', resp.headers)
+        body = resp.data
+
+        with open(path, 'ab') as csvfile:
+            csvfile.write(b'\n10,2013-09-09,09:00:00,17:00:00\n')
+        os.utime(path, (second + 0.6, second + 0.6))
+        resp = self.client.get(
+            url, headers={'If-Modified-Since': http_date(second)}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.data, body)
+
+    def test_api_conditional_last_weeks(self):
+        """
+        Test if ranges ending today aren't answered with 304 once the day
+        is over.
+        """
+        days = [datetime.date(2013, 9, 12)]
+
+        class Today(datetime.date):
+            """
+            Date whose today is under test's control.
+            """
+
+            @classmethod
+            def today(cls):
+                return days[0]
+
+        self.addCleanup(setattr, utils, 'date', utils.date)
+        utils.date = Today
+        url = '/api/v1/presence_weekday/10?last_weeks=1'
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Last-Modified', resp.headers)
+        etag = resp.headers['ETag']
+        self.assertEqual(
+            self.client.get(url, headers={'If-None-Match': etag}).status_code,
+            304
+        )
+
+        days[0] = datetime.date(2013, 9, 19)
+        fresh = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(fresh.status_code, 200)
+        self.assertNotEqual(fresh.headers['ETag'], etag)
+        self.assertNotEqual(fresh.data, resp.data)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?last_weeks=1&to=2013-09-12'
+        )
+        self.assertIn('Last-Modified', resp.headers)
+
+    def test_api_gzip_and_cache_control(self):
+        """
+        Test if big responses are gzipped and get Cache-Control header.
+        """
+        main.app.config.update({
+            'JSON_GZIP_MIN_SIZE': 100,
+            'JSON_CACHE_CONTROL': 'max-age=60',
+        })
+        self.addCleanup(main.app.config.pop, 'JSON_GZIP_MIN_SIZE')
+        self.addCleanup(main.app.config.pop, 'JSON_CACHE_CONTROL')
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(resp.headers['ETag'].endswith('-gzip"'))
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(resp.data)).read()
+        self.assertEqual(len(json.loads(body)), 2)
+
+        resp = self.client.get('/api/v1/users')
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get(
+            '/api/v1/users/10', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_json_backends(self):
+        """
+        Test if every installed JSON backend serializes the same value.
+        """
+        value = [['Mon', 0.5], ('Tue', 30047), {'image': 'https://a/b'}]
+        backends = list(serializers.JSON_BACKENDS) + \
+            list(serializers.LOSSY_JSON_BACKENDS)
+        for backend in backends:
+            self.assertEqual(
+                json.loads(serializers.get_dumps(backend)(value)),
+                json.loads(json.dumps(value))
+            )
+        self.assertIs(serializers.get_dumps('missing'), json.dumps)
+
+    def test_json_backends_precision(self):
+        """
+        Test if backends picked by "auto" keep full float precision.
+        """
+        value = [['Mon', 30047.333333333332], 1.0 / 3, {'mean': 1e20}]
+        for backend in serializers.JSON_BACKENDS:
+            self.assertEqual(
+                serializers.get_dumps(backend)(value), json.dumps(value)
+            )
+        self.assertIs(serializers.get_dumps('auto'), json.dumps)
+
+    def test_api_single_user(self):
+        """
+        Test single user details.
+        """
+        resp = self.client.get('/api/v1/users/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {
+            'image': 'https://intranet.stxnext.pl:443/api/images/users/176',
+            'name': 'Adrian K.'
+        })
+        resp = self.client.get('/api/v1/users/12')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_groups(self):
+        """
+        Test statistics of everyone and of groups from users xml.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        with open(TEST_DATA_XML, 'rb') as xmlfile:
+            xml = xmlfile.read()
+        xml = xml.replace(
+            b'<name>Adam P.</name>',
+            b'<name>Adam P.</name><group>dev</group><group>qa</group>'
+        ).replace(
+            b'<name>Adrian K.</name>',
+            b'<name>Adrian K.</name><group>dev</group>'
+        )
+        with open(path, 'wb') as xmlfile:
+            xmlfile.write(xml)
+        main.app.config['DATA_USERS_XML'] = path
+
+        resp = self.client.get('/api/v1/groups')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            [{'name': 'dev', 'users': 2}, {'name': 'qa', 'users': 1}]
+        )
+
+        qa_group = json.loads(self.client.get('/api/v1/groups/qa').data)
+        self.assertEqual(qa_group['users'], 1)
+        for endpoint in ('presence_weekday', 'average_by_month'):
+            self.assertEqual(
+                qa_group[endpoint],
+                json.loads(self.client.get(
+                    '/api/v1/{0}/10'.format(endpoint)
+                ).data)
+            )
+
+        company = json.loads(self.client.get('/api/v1/company').data)
+        self.assertEqual(company['users'], 2)
+        self.assertEqual(
+            company, json.loads(self.client.get('/api/v1/groups/dev').data)
+        )
+        totals = [
+            json.loads(self.client.get(
+                '/api/v1/presence_weekday/{0}'.format(user_id)
+            ).data)
+            for user_id in (10, 11)
+        ]
+        self.assertEqual(company['presence_weekday'][1:], [
+            [first[0], first[1] + second[1]]
+            for first, second in zip(totals[0][1:], totals[1][1:])
+        ])
+        resp = self.client.get('/api/v1/groups/ops')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config['DATA_USERS_XML_PARSER'] = 'stream'
+        try:
+            self.assertEqual(utils.load_users()[10]['groups'], ['dev', 'qa'])
+        finally:
+            main.app.config['DATA_USERS_XML_PARSER'] = 'tree'
+
+    def test_api_status(self):
+        """
+        Test data status without background refresher.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/api/v1/status')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(data['refresher'])
+        self.assertEqual(data['data']['rows'], 9)
+        self.assertEqual(data['data']['users'], 2)
+
+    def test_metrics(self):
+        """
+        Test Prometheus metrics of requests, helpers and caches.
+        """
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        main.app.config['METRICS_ENABLED'] = True
+        try:
+            self.client.get('/api/v1/users')
+            self.client.get('/api/v1/users')
+            self.client.get('/api/v1/presence_weekday/10')
+            resp = self.client.get('/metrics')
+        finally:
+            main.app.config['METRICS_ENABLED'] = False
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        self.assertIn('presence_data_rows 9', lines)
+        self.assertIn(
+            '# TYPE presence_request_duration_seconds histogram', lines
+        )
+        self.assertIn(
+            'presence_function_duration_seconds_count'
+            '{function="get_data"}',
+            resp.data
+        )
+        self.assertIn(
+            'presence_request_duration_seconds_bucket'
+            '{endpoint="users_view",status="200",le="+Inf"}',
+            resp.data
+        )
+        self.assertIn(
+            'presence_cache_requests_total'
+            '{function="parse_users_xml",result="hit"}',
+            resp.data
+        )
+
+    def test_profiling(self):
+        """
+        Test profiling of requests asking for it.
+        """
+        self.assertFalse(profiling.install_profiler(main.app))
+        main.app.config['PROFILING_ENABLED'] = True
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertTrue(profiling.install_profiler(main.app))
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertNotIn('X-Profile-Summary', resp.headers)
+
+            resp = self.client.get('/api/v1/presence_weekday/10?_profile=1')
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(
+                resp.headers['X-Profile-Summary'].startswith('total=')
+            )
+
+            main.app.config['PROFILE_DIR'] = directory
+            resp = self.client.get(
+                '/api/v1/presence_weekday/10', headers={'X-Profile': '1'}
+            )
+            name = resp.headers['X-Profile-File']
+            self.assertEqual(os.path.basename(name), name)
+            self.assertTrue(os.path.exists(os.path.join(directory, name)))
+
+            # a failing request doesn't leave the profiler on
+            main.app.config['DATA_CSV'] = os.path.join(directory, 'missing')
+            try:
+                resp = self.client.get(
+                    '/api/v1/presence_weekday/10', headers={'X-Profile': '1'}
+                )
+                self.assertEqual(resp.status_code, 500)
+            except IOError:
+                pass
+            self.assertIsNone(sys.getprofile())
+        finally:
+            main.app.config['PROFILING_ENABLED'] = False
+            main.app.config['PROFILE_DIR'] = None
+            main.app.before_request_funcs[None].remove(
+                profiling.start_profiler
+            )
+            main.app.after_request_funcs[None].remove(
+                profiling.stop_profiler
+            )
+            main.app.teardown_request_funcs[None].remove(
+                profiling.discard_profiler
+            )
+            shutil.rmtree(directory)
+
+    def test_background_refresher(self):
+        """
+        Test if refresher loads data up front and reports its status.
+        """
+        # long enough for no periodic run to happen before the checks
+        main.app.config['REFRESH_INTERVAL'] = 60
+        refresher = refresh.start_refresher(main.app)
+        try:
+            self.assertTrue(utils.LOADER.background)
+            self.assertEqual(refresher.status['runs'], 1)
+            self.assertEqual(len(utils.USERS['DATA']), 2)
+            resp = self.client.get('/api/v1/status')
+            data = json.loads(resp.data)
+            self.assertTrue(data['refresher']['alive'])
+            self.assertEqual(data['refresher']['errors'], 0)
+        finally:
+            refresher.stop()
+            refresher.join()
+            del main.app.extensions['presence_refresher']
+            main.app.config.pop('REFRESH_INTERVAL')
+            utils.USERS['DATA'] = None
+        self.assertFalse(utils.LOADER.background)
+
+    def test_api_bulk(self):
+        """
+        Test statistics of many users in one response.
+        """
+        resp = self.client.get(
+            '/api/v1/bulk?users=10,12&metrics=presence_weekday'
+        )
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(data, {
+            '10': {
+                'presence_weekday': json.loads(self.client.get(
+                    '/api/v1/presence_weekday/10'
+                ).data),
+            },
+            '12': None,
+        })
+
+        data = json.loads(self.client.get('/api/v1/bulk?users=all').data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(data['11'].keys(), [
+            'mean_time_weekday', 'presence_weekday',
+            'presence_start_end', 'average_by_month',
+        ])
+        self.assertEqual(
+            data['11']['average_by_month'],
+            json.loads(self.client.get('/api/v1/average_by_month/11').data)
+        )
+
+        resp = self.client.get('/api/v1/bulk?users=x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/bulk?metrics=unknown')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_export_rows(self):
+        """
+        Test streaming export of daily rows.
+        """
+        resp = self.client.get(
+            '/api/v1/export/rows?users=10,12&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertIn('presence.csv', resp.headers['Content-Disposition'])
+        self.assertEqual(resp.data.splitlines(), [
+            b'user_id,date,start,end',
+            b'10,2013-09-10,09:39:05,17:59:52',
+            b'10,2013-09-11,09:19:52,16:07:37',
+        ])
+
+        resp = self.client.get('/api/v1/export/rows?format=ndjson')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(lines[3], {
+            'user_id': 11, 'date': '2013-09-05',
+            'start': '09:28:08', 'end': '15:51:27',
+        })
+
+        resp = self.client.get('/api/v1/export/rows?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export/rows?users=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_export_aggregates(self):
+        """
+        Test streaming export of statistics.
+        """
+        resp = self.client.get('/api/v1/export/aggregates')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = [line.split(b',') for line in resp.data.splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            lines[0][:3], [b'user_id', b'mean_time_Mon', b'mean_time_Tue']
+        )
+        self.assertEqual(len(lines[0]), 1 + 7 * 4 + 12)
+        self.assertEqual([line[0] for line in lines[1:]], [b'10', b'11'])
+        row = dict(zip(lines[0], lines[1]))
+        self.assertEqual(row[b'presence_Wed'], b'24465')
+        self.assertEqual(row[b'start_Wed'], b'33592.0')
+        self.assertEqual(row[b'hours_Sep'], json.dumps(json.loads(
+            self.client.get('/api/v1/average_by_month/10').data
+        )[8][1]).encode())
+
+        resp = self.client.get('/api/v1/export/aggregates?users=12')
+        self.assertEqual(resp.data.splitlines(), [b','.join(lines[0])])
+
+        # data is taken once, not again for every user
+        calls = []
+        get_data = utils.get_data
+
+        def counted():
+            """
+            Counts data lookups.
+            """
+            calls.append(None)
+            return get_data()
+
+        utils.get_data = counted
+        self.addCleanup(setattr, utils, 'get_data', get_data)
+        resp = self.client.get('/api/v1/export/aggregates?from=2013-09-11')
+        self.assertEqual(len(resp.data.splitlines()), 3)
+        # the one of the conditional request check
+        self.assertEqual(len(calls), 1)
+
+        resp = self.client.get(
+            '/api/v1/export/aggregates?format=ndjson&users=11,12,10'
+            '&from=2013-09-11'
+        )
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([line['user_id'] for line in lines], [11, 10])
+        self.assertEqual(
+            lines[1]['presence_weekday'],
+            json.loads(self.client.get(
+                '/api/v1/presence_weekday/10?from=2013-09-11'
+            ).data)
+        )
+
+    def test_api_date_range(self):
+        """
+        Test if statistics can be limited to a range of dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(json.loads(resp.data)[1:5], [
+            ['Mon', 0], ['Tue', 0], ['Wed', 24465], ['Thu', 0],
+        ])
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10?last_weeks=1&to=2013-09-10'
+        )
+        self.assertEqual(json.loads(resp.data)[1:4], [
+            ['Tue', 30047], ['Wed', 0], ['Thu', 0],
+        ])
+
+        resp = self.client.get('/api/v1/average_by_month/10?from=2013-10-01')
+        self.assertEqual(json.loads(resp.data)[8], ['Sep', 0])
+
+        resp = self.client.get(
+            '/api/v1/bulk?users=10&metrics=presence_start_end&to=2013-09-11'
+        )
+        self.assertEqual(
+            json.loads(resp.data)['10']['presence_start_end'][3],
+            ['Thu', 0, 0]
+        )
+
+        for query in ('from=2013-13-01', 'last_weeks=0', 'last_weeks=x',
+                      'last_weeks=1000000', 'last_weeks=' + '9' * 30,
+                      'to=0001-01-05&last_weeks=2'):
+            resp = self.client.get(
+                '/api/v1/presence_start_end/10?' + query
+            )
+            self.assertEqual(resp.status_code, 400)
 
     def test_api_presence_weekday(self):
         """
@@ -133,18 +728,18 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         Tests average hourly presence by month api response.
         """
         expected_data = [
-            ['Jan', []],
-            ['Feb', []],
-            ['Mar', []],
-            ['Apr', []],
-            ['May', []],
-            ['Jun', []],
-            ['Jul', []],
-            ['Aug', []],
+            ['Jan', 0],
+            ['Feb', 0],
+            ['Mar', 0],
+            ['Apr', 0],
+            ['May', 0],
+            ['Jun', 0],
+            ['Jul', 0],
+            ['Aug', 0],
             ['Sep', 20],
-            ['Oct', []],
-            ['Nov', []],
-            ['Dec', []]
+            ['Oct', 0],
+            ['Nov', 0],
+            ['Dec', 0]
         ]
 
         resp = self.client.get('/api/v1/average_by_month/10')
@@ -172,12 +767,200 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         pass
 
+    def test_group_aggregates_once(self):
+        """
+        Test if concurrent calls compute group aggregates only once.
+        """
+        main.app.config['DATA_USERS_XML'] = TEST_DATA_XML
+        calls = []
+        group_aggregates = utils.group_aggregates
+
+        def slow(index, users):
+            """
+            Counts computations and gives others time to come.
+            """
+            calls.append(index)
+            time.sleep(0.05)
+            return group_aggregates(index, users)
+
+        utils.group_aggregates = slow
+        self.addCleanup(setattr, utils, 'group_aggregates', group_aggregates)
+        utils.GROUP_AGGREGATES['DATA'] = None
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(utils.get_group_aggregates())
+            )
+            for _ in xrange(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        for everyone, _ in results:
+            self.assertIs(everyone, results[0][0])
+        self.assertIs(utils.get_group_aggregates()[0], results[0][0])
+
+    def test_load_data_in_process(self):
+        """
+        Test if the app never forks parsers, whatever DATA_CSV_WORKERS.
+        """
+        def forbidden(*args):
+            """
+            Fails the test if called.
+            """
+            self.fail('parsed in processes: {0!r}'.format(args))
+
+        main.app.config.update({
+            'DATA_CSV': SAMPLE_DATA_CSV,
+            'DATA_CSV_WORKERS': 4,
+        })
+        self.addCleanup(main.app.config.pop, 'DATA_CSV_WORKERS')
+        utils.LOADER, loader = ingest.CSVLoader(), utils.LOADER
+        self.addCleanup(setattr, utils, 'LOADER', loader)
+        read_parallel = ingest.read_parallel
+        ingest.read_parallel = forbidden
+        self.addCleanup(setattr, ingest, 'read_parallel', read_parallel)
+        min_chunk_size = ingest.MIN_CHUNK_SIZE
+        ingest.MIN_CHUNK_SIZE = 1024
+        self.addCleanup(setattr, ingest, 'MIN_CHUNK_SIZE', min_chunk_size)
+
+        self.assertIn(10, utils.load_data())
+
+    def test_offload(self):
+        """
+        Test calling functions directly without gevent executor.
+        """
+        self.assertEqual(
+            gevent_server.offload(threading.current_thread),
+            threading.current_thread()
+        )
+
+    @unittest.skipUnless(gevent_server.available(), 'gevent is not installed')
+    def test_offload_executor(self):
+        """
+        Test offloading calls from the event loop to the threadpool.
+        """
+        gevent_server.start_executor(2)
+        try:
+            self.assertNotEqual(
+                gevent_server.offload(threading.current_thread),
+                threading.current_thread()
+            )
+            # other threads call directly
+            result = []
+            worker = threading.Thread(target=lambda: result.append(
+                gevent_server.offload(threading.current_thread)
+            ))
+            worker.start()
+            worker.join()
+            self.assertEqual(result, [worker])
+        finally:
+            gevent_server.stop_executor()
+
+    @unittest.skipUnless(gevent_server.available(), 'gevent is not installed')
+    def test_offload_views(self):
+        """
+        Test serving per-user data through the threadpool.
+        """
+        client = main.app.test_client()
+        urls = (
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/bulk?users=all&last_weeks=52&to=2013-09-13',
+            '/api/v1/export/aggregates?format=ndjson&from=2013-09-01',
+            '/api/v1/export/rows?users=10',
+        )
+        expected = [client.get(url).data for url in urls]
+        threads = set()
+        aggregate_between = views.aggregate_between
+
+        def recording(*args):
+            """
+            Records thread calling aggregate_between.
+            """
+            threads.add(threading.current_thread())
+            return aggregate_between(*args)
+
+        self.addCleanup(setattr, views, 'aggregate_between', aggregate_between)
+        views.aggregate_between = recording
+        gevent_server.start_executor(2)
+        try:
+            self.assertEqual([client.get(url).data for url in urls], expected)
+        finally:
+            gevent_server.stop_executor()
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    @unittest.skipUnless(gevent_server.available(), 'gevent is not installed')
+    def test_patch_on_import(self):
+        """
+        Test patching the standard library before Flask is imported.
+        """
+        env = dict(os.environ)
+        env[gevent_server.PATCH_ENVIRON] = '1'
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import presence_analyzer, flask, socket; '
+            'from gevent import monkey; '
+            'print monkey.is_module_patched("socket"), '
+            'socket.socket.__module__',
+        ], env=env, stderr=open(os.devnull, 'w'))
+        self.assertEqual(output.split()[0], b'True')
+        self.assertTrue(output.split()[1].startswith(b'gevent'))
+
+    def test_timed(self):
+        """
+        Test recording durations only with metrics enabled.
+        """
+        histogram = metrics.FUNCTION_SECONDS
+        histogram.series.pop(('dummy',), None)
+
+        @metrics.timed
+        def dummy(value):
+            """
+            Returns value.
+            """
+            return value
+
+        self.assertEqual(dummy(1), 1)
+        self.assertNotIn(('dummy',), histogram.series)
+        main.app.config['METRICS_ENABLED'] = True
+        try:
+            dummy(2)
+            dummy(3)
+        finally:
+            main.app.config['METRICS_ENABLED'] = False
+        series = histogram.series.pop(('dummy',))
+        self.assertEqual(series[-1], 2)
+        self.assertEqual(series[len(metrics.BUCKETS) - 1], 2)
+
+    def test_timed_hot_paths(self):
+        """
+        Test recording durations of loads and aggregations.
+        """
+        histogram = metrics.FUNCTION_SECONDS
+        labels = [('build_aggregates',), ('aggregate_between',)]
+        for label in labels:
+            histogram.series.pop(label, None)
+        main.app.config['METRICS_ENABLED'] = True
+        try:
+            ingest.CSVLoader().load(TEST_DATA_CSV)
+            utils.aggregate_between(10, datetime.date(2013, 9, 1))
+        finally:
+            main.app.config['METRICS_ENABLED'] = False
+        for label in labels:
+            self.assertIn(label, histogram.series)
+            histogram.series.pop(label)
+
     def test_get_data(self):
         """
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -251,13 +1034,22 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         Test if caching decorator returns result from cache.
         """
-        cache_func = utils.cache(600)(func)
+        calls = []
+        cache_func = utils.cache(600)(lambda arg: calls.append(arg) or arg)
+
+        self.assertEqual(cache_func(10), 10)
+        self.assertEqual(cache_func(10), 10)
+        self.assertEqual(cache_func(123), 123)
+        self.assertEqual(calls, [10, 123])
 
+        utils.STORAGE['<lambda>'][((10,), ())]['TIME'] = 0
         self.assertEqual(cache_func(10), 10)
-        self.assertEqual(cache_func(123), 10)
+        self.assertEqual(calls, [10, 123, 10])
 
-        utils.STORAGE['func']['TIME'] = 0
-        self.assertEqual(124, cache_func(124))
+        cache_func = utils.cache(600)(func)
+        self.assertEqual(cache_func(10), 10)
+        self.assertEqual(cache_func(arg=10), 10)
+        self.assertEqual(len(utils.STORAGE['func']), 2)
 
         def test_all_ids_to_names_xml(self): # pylint: disable=unused-variable
             """
@@ -292,16 +1084,876 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
             self.assertEqual(expected_data, result_from_function)
 
+    def test_caching_decorator_maxsize(self):
+        """
+        Test if least recently used results are evicted.
+        """
+        cache_func = utils.cache(600, maxsize=2)(func)
+        cache_func(1)
+        cache_func(2)
+        cache_func(1)
+        cache_func(3)
+
+        self.assertEqual(
+            utils.STORAGE['func'].keys(),
+            [((1,), ()), ((3,), ())]
+        )
+
+    def test_caching_decorator_single_flight(self):
+        """
+        Test if concurrent misses compute the result only once.
+        """
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(arg):
+            """
+            Blocks until released.
+            """
+            calls.append(arg)
+            started.set()
+            release.wait()
+            return arg
+
+        cache_func = utils.cache(600)(slow)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache_func(5)))
+            for _ in xrange(5)
+        ]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [5])
+        self.assertEqual(results, [5] * 5)
+
+    def test_caching_decorator_stale(self):
+        """
+        Test if expired result is returned while refreshed in background.
+        """
+        values = iter([1, 2])
+        release = threading.Event()
+
+        def slow():
+            """
+            Blocks on every call but the first one.
+            """
+            value = next(values)
+            if value > 1:
+                release.wait()
+            return value
+
+        cache_func = utils.cache(600, stale=True)(slow)
+        self.assertEqual(cache_func(), 1)
+        utils.STORAGE['slow'][((), ())]['TIME'] = 0
+
+        self.assertEqual(cache_func(), 1)
+        release.set()
+        for _ in xrange(100):
+            if utils.STORAGE['slow'][((), ())]['DATA'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache_func(), 2)
+
+    def test_users_xml_parsers_agree(self):
+        """
+        Test if streaming users parser returns the same map as tree parser.
+        """
+        tree = utils.parse_users_xml(USERS_XML, 0, 0, 'tree')
+        stream = utils.parse_users_xml(USERS_XML, 0, 0, 'stream')
+
+        self.assertEqual(tree, stream)
+        self.assertEqual(tree[141], {
+            'name': 'Adam P.',
+            'image': 'https://intranet.stxnext.pl:443/api/images/users/141',
+        })
+
+    def test_load_users_mtime(self):
+        """
+        Test if users map is parsed again only after users xml changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        shutil.copy(TEST_DATA_XML, path)
+        main.app.config.update({'DATA_USERS_XML': path})
+        self.addCleanup(
+            main.app.config.update, {'DATA_USERS_XML': TEST_DATA_XML}
+        )
+
+        users = utils.load_users()
+        self.assertIs(utils.load_users(), users)
+
+        with open(path, 'r') as xmlfile:
+            content = xmlfile.read()
+        with open(path, 'w') as xmlfile:
+            xmlfile.write(content.replace('Adam P.', 'Adam Pe.'))
+        self.assertEqual(utils.load_users()[10]['name'], 'Adam Pe.')
+
     def test_average_by_month(self):
+        """
+        Test if function returns correct list of averages.
+        """
+        expected_data = [[], [], [], [], [], [], [], [], 20, [], [], []]
+
+        data = utils.get_data()
+        result_from_function = utils.group_by_average_monthly_hours(data[10])
+
+        self.assertEqual(result_from_function, expected_data)
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def test_from_rows_sorts_and_keeps_last(self):
+        """
+        Test if rows are sorted and the last duplicate wins.
+        """
+        day = datetime.date(2013, 9, 10).toordinal()
+        data = store.PresenceStore.from_rows([
+            (11, day, 100, 200),
+            (10, day + 1, 300, 400),
+            (10, day, 500, 600),
+            (10, day + 1, 700, 800),
+        ])
+
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(list(data.user_ids), [10, 10, 11])
+        self.assertEqual(list(data[10]), [
+            datetime.date(2013, 9, 10),
+            datetime.date(2013, 9, 11),
+        ])
+        self.assertEqual(data[10][datetime.date(2013, 9, 11)], {
+            'start': datetime.time(0, 11, 40),
+            'end': datetime.time(0, 13, 20),
+        })
+
+    def test_user_presence_mapping(self):
+        """
+        Test if user view behaves like a dict keyed by date.
+        """
+        day = datetime.date(2013, 9, 10)
+        data = store.PresenceStore.from_rows([
+            (10, day.toordinal(), 3600, 7200),
+        ])
+
+        self.assertNotIn(12, data)
+        self.assertIn(day, data[10])
+        self.assertNotIn(datetime.date(2013, 9, 11), data[10])
+        self.assertEqual(len(data[10]), 1)
+        self.assertEqual(data[10].items(), [
+            (day, {'start': datetime.time(1), 'end': datetime.time(2)}),
+        ])
+        self.assertEqual(list(data[10].rows()), [
+            (day.toordinal(), 3600, 7200),
+        ])
+        with self.assertRaises(KeyError):
+            data[10][datetime.date(2013, 9, 11)] # pylint: disable=W0104
+
+    def test_between(self):
+        """
+        Test if date range view contains only rows within the range.
+        """
+        day = datetime.date(2013, 9, 10)
+        data = store.PresenceStore.from_rows([
+            (10, day.toordinal() + i, i, i) for i in xrange(5)
+        ] + [(11, day.toordinal(), 0, 0)])
+
+        view = data[10].between(
+            day + datetime.timedelta(1),
+            day + datetime.timedelta(3)
+        )
+        self.assertEqual(list(view), [
+            day + datetime.timedelta(i) for i in (1, 2, 3)
+        ])
+        self.assertEqual(len(data[10].between(last=day)), 1)
+        self.assertEqual(len(data[10].between(first=day.replace(2014))), 0)
+        self.assertEqual(len(data[11].between()), 1)
+
+    def test_merged(self):
+        """
+        Test if merged rows are sorted and override existing ones.
+        """
+        data = store.PresenceStore.from_rows([
+            (10, 5, 1, 2), (10, 7, 1, 2), (12, 1, 1, 2), (14, 1, 1, 2),
+        ])
+        merged = data.merged(store.PresenceStore.from_rows([
+            (10, 6, 3, 4), (10, 7, 5, 6), (11, 1, 1, 2), (14, 2, 1, 2),
+        ]))
+
+        self.assertEqual(zip(
+            merged.user_ids, merged.dates, merged.starts, merged.ends
+        ), [
+            (10, 5, 1, 2), (10, 6, 3, 4), (10, 7, 5, 6), (11, 1, 1, 2),
+            (12, 1, 1, 2), (14, 1, 1, 2), (14, 2, 1, 2),
+        ])
+        self.assertEqual(merged.offsets[12], (4, 5))
+        self.assertEqual(data.row_count, 4)
+
+
+class PresenceAnalyzerIngestTestCase(unittest.TestCase):
+    """
+    CSV parsing tests.
+    """
+
+    def test_parsers_agree(self):
+        """
+        Test if fast parser returns the same rows as strptime parser.
+        """
+        lines = [
+            'user_id,date,start,end',
+            '10,2013-09-10,09:39:05,17:59:52',
+            '10,2013-9-11,9:19:52,16:07:37',
+            '10,2013-02-30,09:00:00,17:00:00',
+            '10,2013-09-12,24:00:00,17:00:00',
+            '10,2013-09-13,09:00:60,17:00:00',
+            'x,2013-09-14,09:00:00,17:00:00',
+            '11,2013-09-15,09:00:00',
+        ]
+        fast = list(ingest.read_presence_rows(lines, 'fast'))
+        slow = list(ingest.read_presence_rows(lines, 'strptime'))
+
+        self.assertEqual(fast, slow)
+        self.assertEqual(fast, [
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+            (10, datetime.date(2013, 9, 11).toordinal(), 33592, 58057),
+        ])
+
+    def test_get_data_strptime_parser(self):
+        """
+        Test if parser can be selected by config.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_CSV_PARSER': 'strptime',
+        })
+        try:
+            data = utils.get_data()
+        finally:
+            main.app.config.pop('DATA_CSV_PARSER')
+        self.assertEqual(data.row_count, 9)
+
+    def test_chunk_ranges(self):
+        """
+        Test splitting file into chunks of whole lines.
+        """
+        csvfile = StringIO.StringIO(b'1,a\n22,bb\n333,ccc\n4444,dddd')
+        ranges = ingest.chunk_ranges(csvfile, 0, 27, 4)
+
+        self.assertEqual(ranges, [(0, 10), (10, 18), (18, 27)])
+        self.assertEqual(
+            ingest.chunk_ranges(csvfile, 4, 27, 10),
+            [(4, 10), (10, 18), (18, 27)]
+        )
+        self.assertEqual(ingest.chunk_ranges(csvfile, 0, 27, 1), [(0, 27)])
+        self.assertEqual(ingest.last_line_end(csvfile, 0, 27), 18)
+        self.assertEqual(ingest.last_line_end(csvfile, 0, 18), 18)
+        self.assertEqual(ingest.last_line_end(csvfile, 0, 3), 0)
+
+    def test_parallel_load(self):
+        """
+        Test if parallel parsing gives the same store as serial one.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(SAMPLE_DATA_CSV, 'rb') as sample:
+            lines = sample.read().splitlines(True)
+        with open(path, 'wb') as csvfile:
+            csvfile.writelines(lines)
+            # later duplicates win, also across chunks
+            csvfile.write(b'10,2011-06-01,10:00:00,11:00:00\n')
+            csvfile.writelines(lines[:100])
+            csvfile.write(b'10,2011-06-02,10:00:00,11:00:00')
+        min_chunk_size = ingest.MIN_CHUNK_SIZE
+        ingest.MIN_CHUNK_SIZE = 16 * 1024
+        try:
+            serial = ingest.CSVLoader()
+            serial.load(path)
+            parallel = ingest.CSVLoader()
+            parallel.load(path, workers=4)
+        finally:
+            ingest.MIN_CHUNK_SIZE = min_chunk_size
+
+        for name in ('user_ids', 'dates', 'starts', 'ends'):
+            self.assertEqual(
+                getattr(parallel.store, name), getattr(serial.store, name)
+            )
+        self.assertEqual(
+            (parallel.offset, parallel.size), (serial.offset, serial.size)
+        )
+        self.assertEqual(
+            parallel.store[10][datetime.date(2011, 6, 2)]['start'],
+            datetime.time(10, 0)
+        )
+
+    def test_loader_tail(self):
+        """
+        Test if loader parses appended rows only and reloads rewritten file.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n10,2013-09-11,09')
+        loader = ingest.CSVLoader()
+
+        data = loader.load(path)
+        self.assertEqual(data.row_count, 1)
+        self.assertIs(loader.load(path), data)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(':00:00,16:00:00\n11,2013-09-10,08:00:00,15:00:00\n')
+        data = loader.load(path)
+        self.assertEqual((loader.full_loads, loader.tail_loads), (1, 1))
+        self.assertEqual(data.row_count, 3)
+        self.assertEqual(
+            data[10][datetime.date(2013, 9, 11)]['end'],
+            datetime.time(16)
+        )
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        data = loader.load(path)
+        self.assertEqual(loader.full_loads, 2)
+        self.assertItemsEqual(data.keys(), [12])
+
+    def test_loader_tail_fragment(self):
+        """
+        Test if row of a completed unterminated line replaces the old one.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        loader = ingest.CSVLoader()
+        self.assertEqual(loader.load(path).row_count, 9)
+
+        # completes the last line into a malformed one
+        with open(path, 'ab') as csvfile:
+            csvfile.write(b'10,2013-09-10,09:00:00,17:00:00\n')
+        data = loader.load(path)
+        self.assertEqual(loader.tail_loads, 1)
+        fresh = ingest.CSVLoader()
+        expected = fresh.load(path)
+        self.assertEqual(data.row_count, 8)
+        self.assertEqual(data.row_count, expected.row_count)
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id in expected:
+            self.assertEqual(dict(data[user_id]), dict(expected[user_id]))
+        self.assertItemsEqual(loader.aggregates, fresh.aggregates)
+        for user_id in fresh.aggregates:
+            self.assertEqual(
+                vars(loader.aggregates[user_id]),
+                vars(fresh.aggregates[user_id])
+            )
+
+    def test_loader_snapshot(self):
+        """
+        Test if loader writes snapshot and starts from it next time.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(SAMPLE_DATA_CSV, path)
+
+        parsed = ingest.CSVLoader()
+        data = parsed.load(path, snapshot=True)
+        self.assertTrue(os.path.exists(snapshot.snapshot_path(path)))
+
+        loader = ingest.CSVLoader()
+        mapped = loader.load(path, snapshot=True)
+        self.assertEqual((loader.snapshot_loads, loader.full_loads), (1, 0))
+        self.assertEqual(mapped.offsets, data.offsets)
+        self.assertEqual(list(mapped.ends), list(data.ends))
+        self.assertIsInstance(loader.aggregates, snapshot.MappedAggregates)
+        self.assertEqual(list(loader.aggregates), sorted(parsed.aggregates))
+        for user_id in parsed.aggregates:
+            self.assertEqual(
+                loader.aggregates[user_id].__dict__,
+                parsed.aggregates[user_id].__dict__
+            )
+        self.assertNotIn(12345, loader.aggregates)
+        self.assertEqual(mapped[10].items(), data[10].items())
+        self.assertEqual(loader.offset, os.path.getsize(path))
+
+        stat = os.stat(path)
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+        data = loader.load(path, snapshot=True)
+        self.assertEqual(loader.tail_loads, 1)
+        self.assertIn(datetime.date(2013, 9, 13), data[10])
+        # tail loads don't rewrite a recent snapshot
+        self.assertIsNotNone(snapshot.load_snapshot(
+            snapshot.snapshot_path(path), stat.st_size, stat.st_mtime
+        ))
+
+        loader.snapshot_interval = 0
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-14,09:00:00,17:00:00\n')
+        loader.load(path, snapshot=True)
+        stat = os.stat(path)
+        self.assertIsNotNone(snapshot.load_snapshot(
+            snapshot.snapshot_path(path), stat.st_size, stat.st_mtime
+        ))
+
+        os.utime(path, (0, 0))
+        loader = ingest.CSVLoader()
+        loader.load(path, snapshot=True)
+        self.assertEqual((loader.snapshot_loads, loader.full_loads), (0, 1))
+
+    def test_shared_dataset(self):
+        """
+        Test if workers attach to a dataset published by loader process.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shared_path = os.path.join(tmpdir, 'shared.dataset')
+        shutil.copy(TEST_DATA_CSV, path)
+
+        publisher = ingest.DatasetPublisher(path, shared_path)
+        self.assertTrue(publisher.publish())
+        self.assertFalse(publisher.publish())
+
+        main.app.config['SHARED_DATASET'] = shared_path
+        self.addCleanup(main.app.config.pop, 'SHARED_DATASET')
+        utils.SHARED, shared = snapshot.SharedDataset(), utils.SHARED
+        self.addCleanup(setattr, utils, 'SHARED', shared)
+        data = utils.get_data()
+        self.assertIs(utils.get_data(), data)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(
+            utils.get_aggregates()[10].weekday_totals()[1], 30047
+        )
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,09:00:00,17:00:00\n')
+        self.assertTrue(publisher.publish())
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+        self.assertEqual(utils.SHARED.attaches, 2)
+
+    def test_snapshot_other_format(self):
+        """
+        Test if snapshots of other format are ignored.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv.snapshot')
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(b'PRESNAP\0' + b'\xff' * 100)
+
+        self.assertIsNone(snapshot.load_snapshot(path))
+        self.assertIsNone(snapshot.load_snapshot(path + '.missing'))
+
+
+class PresenceAnalyzerAggregatesTestCase(unittest.TestCase):
+    """
+    Aggregate index tests.
+    """
+
+    def test_aggregates_match_group_by(self):
+        """
+        Test if precomputed aggregates equal results of group_by helpers.
+        """
+        data = ingest.CSVLoader().load(SAMPLE_DATA_CSV)
+        index = aggregates.build_aggregates(data)
+
+        self.assertItemsEqual(index.keys(), data.keys())
+        for user_id in data:
+            user_data, user_aggregates = data[user_id], index[user_id]
+            weekdays = utils.group_by_weekday(user_data)
+            self.assertEqual(
+                user_aggregates.weekday_totals(),
+                [sum(intervals) for intervals in weekdays]
+            )
+            self.assertEqual(
+                user_aggregates.weekday_means(),
+                [utils.mean(intervals) for intervals in weekdays]
+            )
+            self.assertEqual(
+                user_aggregates.start_end_means(),
+                utils.group_by_average_start_end_time(user_data)
+            )
+            self.assertEqual(
+                user_aggregates.monthly_averages(),
+                utils.group_by_average_monthly_hours(user_data)
+            )
+
+    @unittest.skipUnless(vectorized.available(), 'NumPy is not installed')
+    def test_vectorized_engine(self):
+        """
+        Test if NumPy engine gives the same results as pure Python one.
+        """
+        data = ingest.CSVLoader().load(SAMPLE_DATA_CSV)
+        helpers = (
+            'group_by_weekday',
+            'group_by_average_start_end_time',
+            'group_by_average_monthly_hours',
+        )
+        for user_id in data:
+            user_data = data[user_id]
+            as_dict = collections.OrderedDict(user_data.iteritems())
+            for helper in helpers:
+                self.assertEqual(
+                    getattr(vectorized, helper)(user_data),
+                    getattr(utils, helper)(as_dict)
+                )
+        self.assertEqual(
+            vectorized.group_by_average_monthly_hours(
+                data[10].between(last=datetime.date(2000, 1, 1))
+            ),
+            [[]] * 12
+        )
+
+    @unittest.skipUnless(vectorized.available(), 'NumPy is not installed')
+    def test_vectorized_aggregates(self):
+        """
+        Test if aggregates built with NumPy equal pure Python ones.
+        """
+        data = ingest.CSVLoader().load(SAMPLE_DATA_CSV)
+        expected = aggregates.build_aggregates(data, engine='python')
+        user_ids = sorted(data.keys())
+        for index in (
+                aggregates.build_aggregates(data),
+                aggregates.build_aggregates(data, user_ids[1::2]),
+        ):
+            for user_id, user_aggregates in index.iteritems():
+                self.assertEqual(
+                    vars(user_aggregates), vars(expected[user_id])
+                )
+        self.assertEqual(aggregates.build_aggregates(data, []), {})
+        user_data = data[user_ids[0]].between(
+            datetime.date(2013, 1, 1), datetime.date(2013, 6, 30)
+        )
+        self.assertTrue(user_data)
+        self.assertEqual(
+            vars(aggregates.UserAggregates.from_sums(
+                vectorized.aggregate_view(user_data)
+            )),
+            vars(aggregates.UserAggregates.from_rows(user_data.rows()))
+        )
+
+    def test_loader_updates_aggregates(self):
+        """
+        Test if tail load recomputes aggregates of changed users only.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '11,2013-09-10,09:00:00,17:00:00\n'
+            )
+        loader = ingest.CSVLoader()
+        loader.load(path)
+        untouched = loader.aggregates[11]
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-17,09:00:00,13:00:00\n')
+        loader.load(path)
+
+        self.assertIs(loader.aggregates[11], untouched)
+        self.assertEqual(loader.aggregates[10].weekday_totals()[1], 43200)
+        self.assertEqual(loader.aggregates[10].monthly_averages()[8], 12)
+
+        # appended rows extend the aggregates, an earlier day or
+        # a replaced one makes them recomputed
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '10,2013-10-01,09:00:00,17:00:00\n'
+                '11,2013-09-10,10:00:00,17:00:00\n'
+                '11,2013-09-09,10:00:00,17:00:00\n'
+            )
+        loader.load(path)
+        for user_id in (10, 11):
+            expected = aggregates.UserAggregates.from_rows(
+                loader.store[user_id].rows()
+            )
+            self.assertEqual(
+                loader.aggregates[user_id].__dict__, expected.__dict__
+            )
+        self.assertEqual(loader.aggregates[11].counts, [1, 1, 0, 0, 0, 0, 0])
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+    """
+    SQLite backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, create a directory for the database.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'presence.sqlite')
+
+    def tearDown(self):
+        """
+        Remove the database and restore default backend.
+        """
+        main.app.config['DATA_BACKEND'] = 'csv'
+        shutil.rmtree(self.directory)
+
+    def test_aggregates_match_csv(self):
+        """
+        Test if SQL aggregates equal the in-memory ones.
+        """
+        self.assertTrue(
+            database.sync_database(SAMPLE_DATA_CSV, self.db_path)
+        )
+        data = ingest.CSVLoader().load(SAMPLE_DATA_CSV)
+        index = aggregates.build_aggregates(data)
+        backend = database.SQLiteBackend()
+        store = backend.load(self.db_path)
+
+        self.assertEqual(backend.version, 1)
+        self.assertEqual(list(store), sorted(data))
+        self.assertEqual(store.row_count, data.row_count)
+        self.assertNotIn(12345, store)
+        with self.assertRaises(KeyError):
+            backend.aggregates[12345] # pylint: disable=pointless-statement
+        first, last = datetime.date(2012, 1, 1), datetime.date(2012, 12, 31)
+        for user_id in data:
+            self.assertEqual(
+                dict(store[user_id].iteritems()),
+                dict(data[user_id].iteritems())
+            )
+            expected, result = index[user_id], backend.aggregates[user_id]
+            self.assertEqual(result.__dict__, expected.__dict__)
+            expected = aggregates.UserAggregates.from_rows(
+                data[user_id].between(first, last).rows()
+            )
+            result = backend.aggregates.between(user_id, first, last)
+            self.assertEqual(result.__dict__, expected.__dict__)
+
+    def test_sync_tail(self):
+        """
+        Test importing only rows appended to CSV file.
+        """
+        path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        database.sync_database(path, self.db_path)
+        self.assertFalse(database.sync_database(path, self.db_path))
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'10,2013-09-10,09:00:00,17:00:00\n')
+            csvfile.write(b'12,2013-09-10,10:00:00,16:00:00\n')
+        self.assertTrue(database.sync_database(path, self.db_path))
+
+        backend = database.SQLiteBackend()
+        store = backend.load(self.db_path)
+        self.assertEqual(backend.version, 2)
+        # the unterminated last line got extended into a malformed one
+        self.assertEqual(store.row_count, 9)
+        self.assertNotIn(datetime.date(2013, 9, 13), store[11])
+        self.assertEqual(
+            store[12][datetime.date(2013, 9, 10)],
+            {'start': datetime.time(10, 0), 'end': datetime.time(16, 0)}
+        )
+        # rollups of the replaced row are updated
+        data = ingest.CSVLoader().load(path)
+        for user_id in (10, 11, 12):
+            expected = aggregates.UserAggregates.from_rows(
+                data[user_id].rows()
+            )
+            self.assertEqual(
+                backend.aggregates[user_id].__dict__, expected.__dict__
+            )
+
+    def test_sync_completed_line(self):
+        """
+        Test if the row of an unterminated line is replaced once the line
+        gets completed into another one.
+        """
+        path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'\n10,2013-09-1')
+        database.sync_database(path, self.db_path)
+        backend = database.SQLiteBackend()
+        store = backend.load(self.db_path)
+        self.assertEqual(store.row_count, 9)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'3,09:00:00,17:00:00\n')
+        self.assertTrue(database.sync_database(path, self.db_path))
+        backend.load(self.db_path)
+        data = ingest.CSVLoader().load(path)
+        self.assertEqual(store.row_count, data.row_count)
+        self.assertEqual(store[10].items(), data[10].items())
+        self.assertEqual(
+            backend.aggregates[10].__dict__,
+            aggregates.UserAggregates.from_rows(data[10].rows()).__dict__
+        )
+
+    def test_unsynced_database(self):
+        """
+        Test refusing database that was not synced yet.
+        """
+        with self.assertRaises(IOError):
+            database.SQLiteBackend().load(self.db_path)
+
+    def test_views(self):
+        """
+        Test if statistics endpoints give the same results with SQLite.
+        """
+        main.app.config.update({
+            'DATA_CSV': SAMPLE_DATA_CSV,
+            'DATA_USERS_XML': USERS_XML,
+            'DATA_SQLITE': self.db_path,
+        })
+        database.sync_database(SAMPLE_DATA_CSV, self.db_path)
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/{0}/{1}'.format(endpoint, user_id)
+            for endpoint in (
+                'mean_time_weekday', 'presence_weekday',
+                'presence_start_end', 'average_by_month',
+            )
+            for user_id in (10, 11, 12345)
+        ]
+        urls += [
+            '/api/v1/presence_weekday/10?from=2012-01-01&to=2012-06-30',
+            '/api/v1/bulk?users=10,11,12345',
+        ]
+        expected = [client.get(url) for url in urls]
+        main.app.config['DATA_BACKEND'] = 'sqlite'
+        for url, resp in zip(urls, expected):
+            result = client.get(url)
+            self.assertEqual(result.status_code, resp.status_code, url)
+            self.assertEqual(result.data, resp.data, url)
+
+
+class PresenceAnalyzerLazyTestCase(unittest.TestCase):
     """
-    Test if function returns correct list of averages.
+    Lazy loading tests.
     """
-    expected_data = [[], [], [], [], [], [], [], [], 20, [], [], []]
 
-    data = utils.get_data()
-    result_from_function = utils.group_by_average_monthly_hours(data[10])
+    def tearDown(self):
+        """
+        Restore eager loading.
+        """
+        main.app.config['DATA_LAZY'] = False
+
+    def test_matches_loader(self):
+        """
+        Test if lazily parsed users equal eagerly loaded ones.
+        """
+        data = ingest.CSVLoader().load(SAMPLE_DATA_CSV)
+        index = aggregates.build_aggregates(data)
+        loader = lazy.LazyLoader(cache_size=3)
+        store = loader.load(SAMPLE_DATA_CSV)
+
+        self.assertEqual(list(store), sorted(data))
+        self.assertEqual(store.row_count, data.row_count)
+        self.assertNotIn(12345, store)
+        with self.assertRaises(KeyError):
+            store[12345] # pylint: disable=pointless-statement
+        for user_id in data:
+            self.assertEqual(store[user_id].rows(), data[user_id].rows())
+            self.assertEqual(
+                loader.aggregates[user_id].__dict__,
+                index[user_id].__dict__
+            )
+        self.assertEqual(len(loader.cache), 3)
+        self.assertEqual(loader.misses, len(data))
+        self.assertEqual(loader.hits, len(data))
+
+    def test_tail(self):
+        """
+        Test indexing appended lines, also completing an unterminated one.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        loader = lazy.LazyLoader()
+        store = loader.load(path)
+        self.assertEqual(len(store[11]), 6)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'\n12,2013-09-10,10:00:00,16:00:00\n')
+            csvfile.write(b'11,2013-09-16,10:00:00,16:00:00\n')
+        loader.load(path)
 
-    self.assertEqual(result_from_function, expected_data)
+        self.assertEqual((loader.full_loads, loader.tail_loads), (1, 1))
+        expected = ingest.CSVLoader().load(path)
+        self.assertEqual(list(store), [10, 11, 12])
+        self.assertEqual(store.row_count, 11)
+        for user_id in expected:
+            self.assertEqual(store[user_id].rows(), expected[user_id].rows())
+
+    def test_malformed_lines(self):
+        """
+        Test if users with only malformed lines are treated as absent.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'\n12,2013-09-10,10:00:00,broken\n')
+            csvfile.write(b'10,2013-09-32,10:00:00,16:00:00\n')
+        loader = lazy.LazyLoader()
+        store = loader.load(path)
+        expected = ingest.CSVLoader().load(path)
+        self.assertIn(12, store)
+        self.assertEqual(store.row_count, 11)
+
+        with self.assertRaises(KeyError):
+            store[12] # pylint: disable=pointless-statement
+        self.assertIsNone(loader.aggregates.get(12))
+        self.assertNotIn(12, store)
+        self.assertEqual(store[10].rows(), expected[10].rows())
+        self.assertEqual(list(store), sorted(expected))
+        self.assertEqual(store.row_count, expected.row_count)
+        store[10] # pylint: disable=pointless-statement
+        self.assertEqual(store.row_count, expected.row_count)
+
+        main.app.config.update({
+            'DATA_CSV': path,
+            'DATA_USERS_XML': USERS_XML,
+            'DATA_LAZY': True,
+        })
+        loader = lazy.LazyLoader()
+        utils.LAZY, lazy_loader = loader, utils.LAZY
+        self.addCleanup(setattr, utils, 'LAZY', lazy_loader)
+        client = main.app.test_client()
+        self.assertEqual(client.get('/api/v1/company').status_code, 200)
+        self.assertEqual(
+            client.get('/api/v1/presence_weekday/12').status_code, 404
+        )
+
+    def test_views(self):
+        """
+        Test if statistics endpoints give the same results lazily.
+        """
+        main.app.config.update({
+            'DATA_CSV': SAMPLE_DATA_CSV,
+            'DATA_USERS_XML': USERS_XML,
+        })
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/presence_start_end/10',
+            '/api/v1/average_by_month/11',
+            '/api/v1/mean_time_weekday/12345',
+            '/api/v1/presence_weekday/10?from=2012-01-01&to=2012-06-30',
+            '/api/v1/bulk?users=10,11,12345',
+        ]
+        expected = [client.get(url) for url in urls]
+        main.app.config['DATA_LAZY'] = True
+        for url, resp in zip(urls, expected):
+            result = client.get(url)
+            self.assertEqual(result.status_code, resp.status_code, url)
+            self.assertEqual(result.data, resp.data, url)
 
 
 def suite():
@@ -311,6 +1963,13 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerIngestTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerAggregatesTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLazyTestCase))
     return base_suite
 
 
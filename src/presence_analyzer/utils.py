@@ -2,23 +2,49 @@
 """
 Helper functions used in views.
 """
-import csv
+import hashlib
+import locale
+import os
 import threading
-import time # pylint: disable=W0611
-from collections import defaultdict
-from datetime import datetime
+import time
+from collections import defaultdict, OrderedDict
+from datetime import date, datetime
 from functools import wraps
-from json import dumps
 from lxml import etree
 
-from flask import Response # pylint: disable=F0401
+from flask import Response, request # pylint: disable=F0401
 
+from . import metrics, vectorized
+from .aggregates import UserAggregates, group_aggregates
+from .database import SQLiteAggregates, SQLiteBackend
+from .gevent_server import offload
+from .ingest import CSVLoader
+from .lazy import LazyLoader
 from .main import app
+from .metrics import timed
+from .serializers import get_dumps, gzip_compress
+from .snapshot import SharedDataset
+from .store import UserPresence
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+locale.setlocale(locale.LC_COLLATE, "pl_PL.UTF-8")
+
 STORAGE = {}
+LOADER = CSVLoader()
+SHARED = SharedDataset()
+SQLITE = SQLiteBackend()
+LAZY = LazyLoader()
+# users map kept up to date by the background refresher
+USERS = {'DATA': None}
+# sorted and serialized users listing, built once per users map
+USERS_LISTING = {'DATA': None}
+# aggregates of everyone and of groups, built once per data version
+GROUP_AGGREGATES = {'DATA': None}
+GROUP_AGGREGATES_LOCK = threading.Lock()
+# hash of package sources, see code_version()
+CODE_VERSION = {'DATA': None}
 
 def jsonify(function):
     """
@@ -29,49 +55,239 @@ def jsonify(function):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        return json_response(dumps(function(*args, **kwargs)))
     return inner
 
 
-def cache(caching_time):
+@timed
+def dumps(value):
+    """
+    Serializes value to JSON with the configured JSON_BACKEND.
+    """
+    return get_dumps(app.config.get('JSON_BACKEND', 'auto'))(value)
+
+
+def json_response(body, etag=None):
+    """
+    Creates a JSON response of already serialized body.
+
+    Bodies of at least JSON_GZIP_MIN_SIZE bytes are gzipped for clients
+    accepting it and JSON_CACHE_CONTROL, if set, becomes Cache-Control
+    header. Given ``etag`` is set as strong ETag and a matching
+    If-None-Match is answered with 304.
+    """
+    resp = Response(body, mimetype='application/json')
+    min_size = app.config.get('JSON_GZIP_MIN_SIZE')
+    if min_size is not None:
+        resp.vary.add('Accept-Encoding')
+        if len(body) >= min_size and request.accept_encodings['gzip']:
+            resp.set_data(gzip_compress(body))
+            resp.headers['Content-Encoding'] = 'gzip'
+            if etag is not None:
+                etag += '-gzip'
+    cache_control = app.config.get('JSON_CACHE_CONTROL')
+    if cache_control:
+        resp.headers['Cache-Control'] = cache_control
+    if etag is not None:
+        resp.set_etag(etag)
+        resp = resp.make_conditional(request)
+    return resp
+
+
+def code_version():
+    """
+    Returns hash of the sources of this package, computed once.
+
+    A deploy changing how responses look changes it too.
+    """
+    version = CODE_VERSION['DATA']
+    if version is None:
+        digest = hashlib.sha1()
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                with open(os.path.join(package, name), 'rb') as source:
+                    digest.update(source.read())
+        version = CODE_VERSION['DATA'] = digest.hexdigest()
+    return version
+
+
+def today():
+    """
+    Returns today's date, the end of ``last_weeks`` date ranges.
+    """
+    return date.today()
+
+
+def data_version():
+    """
+    Returns ``(token, last modified)`` of currently loaded presence data.
+
+    The token is a hash of the state of the loaded file, not of the
+    in-process version counter, so every worker loading the same data
+    derives the same token; code_version() and JSON_BACKEND take part
+    in it, so a deploy changing the output can't reuse an old one.
+
+    Last modified is the modification time of the file in whole seconds,
+    None if unknown or within the current second: the file may still
+    change in that second and If-Modified-Since couldn't tell.
+    """
+    get_data()
+    loader = current_loader()
+    state = (
+        code_version(),
+        app.config.get('JSON_BACKEND', 'auto'),
+        type(loader).__name__,
+    ) + tuple(
+        getattr(loader, name, None)
+        for name in ('source', 'path', 'identity', 'size', 'mtime')
+    )
+    modified = getattr(loader, 'mtime', None)
+    if modified is not None:
+        if int(modified) < int(time.time()):
+            modified = datetime.utcfromtimestamp(int(modified))
+        else:
+            modified = None
+    return hashlib.sha1(repr(state)).hexdigest(), modified
+
+
+def conditional(users=False):
+    """
+    Tags responses of wrapped view with data_version() and answers
+    requests for unchanged data with 304 before the view is called.
+
+    With ``users`` set the users xml contents take part in the ETag too
+    and Last-Modified is left out, as it follows presence data only.
+    The same goes for today's date in ``last_weeks`` requests without
+    ``to``, whose date range moves every day.
+    A gzipped body gets ETag with ``-gzip`` suffix, like in
+    json_response().
+    """
+    def decorator(function):
+        """
+        Wraps the view.
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            etag, modified = data_version()
+            if users:
+                etag = hashlib.sha1(etag + users_listing()[1]).hexdigest()
+                modified = None
+            if request.args.get('last_weeks') and \
+                    not request.args.get('to'):
+                # the window ends today, so the response changes with
+                # the date even if the data doesn't
+                etag = hashlib.sha1(
+                    etag + today().isoformat()
+                ).hexdigest()
+                modified = None
+            if request.if_none_match:
+                matched = next((
+                    tag for tag in (etag, etag + '-gzip')
+                    if request.if_none_match.contains(tag)
+                ), None)
+            elif request.if_modified_since and modified is not None:
+                matched = etag if request.if_modified_since >= modified \
+                    else None
+            else:
+                matched = None
+            if matched is not None:
+                resp = Response(status=304)
+                if app.config.get('JSON_GZIP_MIN_SIZE') is not None:
+                    resp.vary.add('Accept-Encoding')
+                cache_control = app.config.get('JSON_CACHE_CONTROL')
+                if cache_control:
+                    resp.headers['Cache-Control'] = cache_control
+            else:
+                resp = function(*args, **kwargs)
+                if resp.headers.get('Content-Encoding') == 'gzip':
+                    etag += '-gzip'
+            resp.set_etag(matched or etag)
+            if modified is not None:
+                resp.last_modified = modified
+            return resp
+        return inner
+    return decorator
+
+
+def cache(caching_time, maxsize=None, stale=False):
     """
     Caches result of a function for a given period of time.
+
+    Results are kept in STORAGE separately for every combination of
+    arguments, at most ``maxsize`` of them (least recently used go
+    first). A missing or expired result is computed by one thread only,
+    while the others wait for it. With ``stale`` set they don't wait but
+    get the expired result, which is refreshed in a background thread.
     """
     def decorator(function):
+        entries = STORAGE[function.__name__] = OrderedDict()
+        name = function.__name__
+        pending = {}
+        lock = threading.Lock()
+
+        def refresh(key, event, args, kwargs):
+            """
+            Computes and stores the result, then wakes up waiting threads.
+            """
+            try:
+                value = function(*args, **kwargs)
+                with lock:
+                    entries.pop(key, None)
+                    entries[key] = {'DATA': value, 'TIME': time.time()}
+                    while maxsize and len(entries) > maxsize:
+                        entries.popitem(last=False)
+                return value
+            finally:
+                with lock:
+                    del pending[key]
+                event.set()
+
         @wraps(function)
         def wrapper(*args, **kwargs):
             """
             This docstring will be overridden by @wraps decorator.
             """
-            lock = threading.Lock()
-            func_name = function.__name__
-
-            with lock:
-                if func_name in STORAGE:
-                    if (time.time() - STORAGE[func_name]['TIME']
-                            <= caching_time):
-                        value = STORAGE[func_name]['DATA']
-                        return value
-
-                STORAGE[func_name] = {
-                    'DATA': function(*args, **kwargs),
-                    'TIME': time.time()
-                }
-
-            return STORAGE[func_name]['DATA']
+            key = (args, tuple(sorted(kwargs.items())))
+            while True:
+                with lock:
+                    entry = entries.pop(key, None)
+                    if entry is not None:
+                        entries[key] = entry
+                        if time.time() - entry['TIME'] <= caching_time:
+                            metrics.count_cache(name, 'hit')
+                            return entry['DATA']
+                    event = pending.get(key)
+                    if event is None:
+                        event = pending[key] = threading.Event()
+                        if not stale or entry is None:
+                            break
+                        refresher = threading.Thread(
+                            target=refresh,
+                            args=(key, event, args, kwargs)
+                        )
+                        refresher.daemon = True
+                        refresher.start()
+                    if stale and entry is not None:
+                        metrics.count_cache(name, 'stale')
+                        return entry['DATA']
+                event.wait()
+            metrics.count_cache(name, 'miss')
+            return refresh(key, event, args, kwargs)
         return wrapper
     return decorator
 
 
-@cache(600)
+@timed
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    Returns a PresenceStore, which keeps rows in compact columns but
+    can be accessed like this structure:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -84,26 +300,91 @@ def get_data():
             },
         }
     }
+
+    Only rows appended since the previous call are parsed, see CSVLoader.
+    While the background refresher runs, the last loaded data is returned
+    right away and never parsed in the request thread. Served by gevent,
+    parsing runs in its threadpool, see gevent_server.offload().
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    loader = current_loader()
+    if loader.background and loader.store is not None:
+        return loader.store
+    return offload(load_data)
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def current_loader():
+    """
+    Returns SQLITE with DATA_BACKEND set to "sqlite", SHARED when
+    SHARED_DATASET is configured, LAZY with DATA_LAZY set and LOADER
+    otherwise.
+    """
+    if app.config.get('DATA_BACKEND', 'csv') == 'sqlite':
+        return SQLITE
+    if app.config.get('SHARED_DATASET'):
+        return SHARED
+    return LAZY if app.config.get('DATA_LAZY', False) else LOADER
 
-    return data
+
+@timed
+def load_data():
+    """
+    Brings presence data up to date with DATA_CSV and returns it.
+
+    With SHARED_DATASET configured the dataset published by the loader
+    process is attached instead and with DATA_BACKEND set to "sqlite"
+    DATA_SQLITE database is used; DATA_CSV is not read at all then.
+    With DATA_LAZY set DATA_CSV is only indexed and users are parsed
+    on demand, see LazyLoader.
+    """
+    if app.config.get('DATA_BACKEND', 'csv') == 'sqlite':
+        return SQLITE.load(app.config['DATA_SQLITE'])
+    if app.config.get('SHARED_DATASET'):
+        return SHARED.load(app.config['SHARED_DATASET'])
+    if app.config.get('DATA_LAZY', False):
+        return LAZY.load(
+            app.config['DATA_CSV'],
+            app.config.get('DATA_CSV_PARSER', 'fast'),
+            app.config.get('DATA_LAZY_CACHE_SIZE', 256)
+        )
+    # DATA_CSV_WORKERS is left to the publisher: forking the threaded
+    # app process could leave locks of other threads held in children
+    return LOADER.load(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_CSV_PARSER', 'fast'),
+        app.config.get('DATA_SNAPSHOT', False),
+        engine=app.config.get('AGGREGATION_ENGINE', 'auto'),
+    )
+
+
+def get_aggregates():
+    """
+    Returns ``{user_id: UserAggregates}`` index of current presence data.
+    """
+    get_data()
+    return current_loader().aggregates
+
+
+@timed
+def aggregate_between(user_id, first=None, last=None, data=None,
+                      aggregates=None):
+    """
+    Returns UserAggregates of user's presence between given dates.
+
+    The SQLite backend aggregates in the database, otherwise rows of
+    the range are aggregated in memory. ``data`` and ``aggregates``
+    default to the current ones; callers going through many users pass
+    those they started with, so all users come from the same load.
+    """
+    if aggregates is None:
+        aggregates = get_aggregates()
+    if isinstance(aggregates, SQLiteAggregates):
+        return aggregates.between(user_id, first, last)
+    if data is None:
+        data = get_data()
+    user_data = data[user_id].between(first, last)
+    if user_data and use_vectorized(user_data):
+        return UserAggregates.from_sums(vectorized.aggregate_view(user_data))
+    return UserAggregates.from_rows(user_data.rows())
 
 
 def assign_ids_to_names_from_xml(data, user=None): # pylint:disable=unused-argument
@@ -111,37 +392,209 @@ def assign_ids_to_names_from_xml(data, user=None): # pylint:disable=unused-argum
     Parses raw user id's from CSV data file and replaces them
     with their corresponding full name from xml file.
     """
-    with open(app.config['DATA_USERS_XML'], 'r') as xmlfile:
+    result = get_users()
+
+    if user:
+        return dict(result[user])
+    else:
+        return {user_id: dict(info) for user_id, info in result.iteritems()}
+
+
+def get_users():
+    """
+    Returns ``{user_id: {'name': .., 'image': ..}}`` map of all users.
+
+    The map is shared and must not be modified.
+    """
+    if current_loader().background and USERS['DATA'] is not None:
+        return USERS['DATA']
+    return offload(load_users)
+
+
+@timed
+def load_users():
+    """
+    Returns users map of DATA_USERS_XML, parsing it only when it changed.
+    """
+    path = app.config['DATA_USERS_XML']
+    stat = os.stat(path)
+    return parse_users_xml(
+        path, stat.st_mtime, stat.st_size,
+        app.config.get('DATA_USERS_XML_PARSER', 'tree')
+    )
+
+
+@cache(float('inf'), maxsize=1)
+@timed
+def parse_users_xml(path, mtime, size, parser): # pylint:disable=W0613
+    """
+    Parses users xml file, ``mtime`` and ``size`` only key the cache.
+
+    ``parser`` is either "tree", which parses the whole document at once,
+    or "stream", which uses iterparse and frees every parsed user element,
+    so memory stays flat for huge directories.
+    """
+    if parser == 'stream':
+        return _iterparse_users(path)
+    with open(path, 'r') as xmlfile:
         root = etree.parse(xmlfile) # pylint:disable=no-member
         server = root.find('server')
-        host = server.find('host').text
-        protocol = server.find('protocol').text
-        port = server.find('port').text
-        users = root.find('users')
-        result = {
-            int(user.get('id')): {
+        server_url = _server_url(
+            server.find('protocol').text,
+            server.find('host').text,
+            server.find('port').text
+        )
+        return {
+            int(user.get('id')): _with_groups({
                 'name': user.find('name').text,
-                'image': "{protocol}://{host}:{port}{user_url}".format(
-                    protocol=protocol,
-                    host=host,
-                    port=port,
-                    user_url=user.find('avatar').text
-                )
-            }
-            for user in users
+                'image': u'{0}{1}'.format(
+                    server_url, user.find('avatar').text
+                ),
+            }, user)
+            for user in root.find('users')
         }
 
-    if user:
-        return result[user]
-    else:
-        return result
 
+def _iterparse_users(path):
+    """
+    Streams users out of xml file with iterparse.
+    """
+    server = {}
+    users = {}
+    context = etree.iterparse( # pylint:disable=no-member
+        path, events=('end',), tag=('protocol', 'host', 'port', 'user')
+    )
+    for _, element in context:
+        if element.tag == 'user':
+            users[int(element.get('id'))] = _with_groups({
+                'name': element.findtext('name'),
+                'image': element.findtext('avatar'),
+            }, element)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif element.getparent().tag == 'server':
+            server[element.tag] = element.text
+    server_url = _server_url(
+        server['protocol'], server['host'], server['port']
+    )
+    for info in users.itervalues():
+        info['image'] = u'{0}{1}'.format(server_url, info['image'])
+    return users
+
+
+def _with_groups(info, element):
+    """
+    Adds ``groups`` listed in optional group elements of user element.
+    """
+    groups = [group.text for group in element.findall('group')]
+    if groups:
+        info['groups'] = groups
+    return info
+
+
+def _server_url(protocol, host, port):
+    """
+    Returns base url of avatars served by the intranet.
+    """
+    return "{protocol}://{host}:{port}".format(
+        protocol=protocol,
+        host=host,
+        port=port
+    )
+
+
+@timed
+def users_listing():
+    """
+    Returns ``(JSON bytes, ETag)`` of all users sorted by name.
+
+    The listing is built once for every users map, it is served as is
+    until users xml changes.
+    """
+    users = get_users()
+    listing = USERS_LISTING['DATA']
+    if listing is None or listing[0] is not users:
+        result = [
+            dict(info, id=user_id) for user_id, info in users.iteritems()
+        ]
+        result.sort(key=lambda k: k['name'], cmp=locale.strcoll)
+        body = dumps(result)
+        listing = (users, body, hashlib.sha1(body).hexdigest())
+        USERS_LISTING['DATA'] = listing
+    return listing[1:]
+
+
+def get_group_aggregates():
+    """
+    Returns ``(everyone, groups)`` aggregates of current data, see
+    aggregates.group_aggregates().
+
+    They are computed once for every data version and users map, by one
+    thread while the others wait.
+    """
+    get_data()
+    loader = current_loader()
+    # version is read before the index: a reload in between leaves
+    # a newer index under an older version, which only gets recomputed
+    version = loader.version
+    index = loader.aggregates
+    key = (loader, version, get_users())
+    cached = GROUP_AGGREGATES['DATA']
+    if not _same_key(cached, key):
+        cached = offload(_build_group_aggregates, key, index)
+    return cached[3:]
+
+
+def _same_key(cached, key):
+    """
+    Checks if cached group aggregates were built for ``(loader, version,
+    users)`` key.
+    """
+    return cached is not None and cached[0] is key[0] and \
+        cached[1] == key[1] and cached[2] is key[2]
+
+
+def _build_group_aggregates(key, index):
+    """
+    Computes and caches group aggregates of index, unless another thread
+    did it meanwhile.
+    """
+    with GROUP_AGGREGATES_LOCK:
+        cached = GROUP_AGGREGATES['DATA']
+        if not _same_key(cached, key):
+            cached = key + group_aggregates(index, key[2])
+            GROUP_AGGREGATES['DATA'] = cached
+        return cached
+
+
+def refresh_data():
+    """
+    Reloads presence and user data, swapping in the new user map at once.
+    """
+    load_data()
+    USERS['DATA'] = load_users()
+
+
+def use_vectorized(user_data):
+    """
+    Checks if group_by_* helpers and aggregate_between() should run
+    on NumPy for given data.
+
+    AGGREGATION_ENGINE set to "python" forces the pure Python helpers.
+    """
+    return (
+        app.config.get('AGGREGATION_ENGINE', 'auto') != 'python' and
+        vectorized.available() and isinstance(user_data, UserPresence)
+    )
 
 
 def group_by_weekday(user_data):
     """
     Groups presence entries by weekday.
     """
+    if use_vectorized(user_data):
+        return vectorized.group_by_weekday(user_data)
     result = [[] for i in xrange(7)]  # one list for every day in week
     for date in user_data:
         start = user_data[date]['start']
@@ -154,6 +607,8 @@ def group_by_average_start_end_time(user_data):
     """
     Groups average start and end times by weekday.
     """
+    if use_vectorized(user_data):
+        return vectorized.group_by_average_start_end_time(user_data)
     buffer = {i: {'start': [], 'end': []} for i in xrange(7)} #pylint: disable=redefined-builtin
 
     for date in user_data:
@@ -177,22 +632,22 @@ def group_by_average_monthly_hours(user_data):
     """
     Groups average hours worked per month.
     """
+    if use_vectorized(user_data):
+        return vectorized.group_by_average_monthly_hours(user_data)
     months = defaultdict(lambda: [])
+    years = defaultdict(set)
 
     for day, times in user_data.iteritems():
         start = seconds_since_midnight(times['start'])
         end = seconds_since_midnight(times['end'])
         hours_per_day = (end - start) / 60 / 60
         months[day.month].append(hours_per_day)
+        years[day.month].add(day.year)
 
     result = [[] for i in xrange(12)]
 
     for month, hours in months.iteritems():
-        months_per_interval = len({
-            (day.year, day.month) for day in user_data
-            if day.month == month
-        })
-        result[month - 1] = (sum(hours) / months_per_interval)
+        result[month - 1] = (sum(hours) / len(years[month]))
 
     return result
 
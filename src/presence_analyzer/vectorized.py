@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy implementations of presence aggregations.
+
+They work on columns of the presence store directly and give the same
+results as the pure Python code: aggregate_users() and aggregate_view()
+compute the sums kept in aggregates.UserAggregates, used to build the
+aggregates index and ranges of the statistics views, and group_by_*
+stand in for the helpers of the same names in utils. Callers use them
+only when NumPy is installed, see available().
+"""
+from datetime import date
+
+try:
+    import numpy # pylint: disable=import-error
+except ImportError:
+    numpy = None # pylint: disable=invalid-name
+
+from .store import TYPECODE
+
+# ordinal of 1970-01-01, day zero of numpy.datetime64
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def available():
+    """
+    Checks if NumPy is installed.
+    """
+    return numpy is not None
+
+
+def columns(user_data):
+    """
+    Returns date ordinals, starts and ends of UserPresence as arrays.
+
+    Columns are wrapped without copying.
+    """
+    store = user_data.store
+    return [
+        _as_array(column)[user_data.lo:user_data.hi]
+        for column in (store.dates, store.starts, store.ends)
+    ]
+
+
+def _as_array(column):
+    """
+    Wraps store column into numpy array.
+    """
+    if isinstance(column, numpy.ndarray):
+        return column
+    return numpy.frombuffer(column, dtype=numpy.dtype(TYPECODE))
+
+
+def group_by_weekday(user_data):
+    """
+    Groups presence entries by weekday.
+    """
+    dates, starts, ends = columns(user_data)
+    weekdays = (dates - 1) % 7
+    intervals = ends - starts
+    return [intervals[weekdays == weekday].tolist() for weekday in xrange(7)]
+
+
+def group_by_average_start_end_time(user_data):
+    """
+    Groups average start and end times by weekday.
+    """
+    dates, starts, ends = columns(user_data)
+    weekdays = (dates - 1) % 7
+    counts = numpy.bincount(weekdays, minlength=7)
+    start_sums = numpy.bincount(weekdays, weights=starts, minlength=7)
+    end_sums = numpy.bincount(weekdays, weights=ends, minlength=7)
+    return [
+        [
+            weekday,
+            float(start_sums[weekday]) / counts[weekday] if counts[weekday]
+            else 0,
+            float(end_sums[weekday]) / counts[weekday] if counts[weekday]
+            else 0,
+        ]
+        for weekday in xrange(7)
+    ]
+
+
+def group_by_average_monthly_hours(user_data):
+    """
+    Groups average hours worked per month.
+    """
+    dates, starts, ends = columns(user_data)
+    # months since 1970-01
+    months = (dates - EPOCH_ORDINAL).astype('datetime64[D]').astype(
+        'datetime64[M]'
+    ).astype(numpy.int64)
+    month_of_year = months % 12
+    hours = numpy.bincount(
+        month_of_year, weights=(ends - starts) // 3600, minlength=12
+    )
+    years = numpy.bincount(numpy.unique(months) % 12, minlength=12)
+    return [
+        int(hours[month]) / int(years[month]) if years[month] else []
+        for month in xrange(12)
+    ]
+
+
+def aggregate_users(store, user_ids):
+    """
+    Yields ``(user_id, sums)`` for given users of a PresenceStore, where
+    ``sums`` maps UserAggregates attributes to their values.
+
+    All users are aggregated in a single pass over their rows.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    segments = [store.offsets[user_id] for user_id in user_ids]
+    dates, starts, ends = [_as_array(column) for column in (
+        store.dates, store.starts, store.ends
+    )]
+    if len(segments) < len(store.offsets):
+        rows = numpy.concatenate(
+            [numpy.arange(lo, hi) for lo, hi in segments]
+        ).astype(numpy.int64)
+        dates, starts, ends = dates[rows], starts[rows], ends[rows]
+    else:
+        # the whole store, users in row order
+        order = numpy.argsort([lo for lo, _ in segments], kind='mergesort')
+        user_ids = [user_ids[i] for i in order]
+        segments = [segments[i] for i in order]
+    lengths = [hi - lo for lo, hi in segments]
+    return zip(user_ids, _aggregate(dates, starts, ends, lengths))
+
+
+def aggregate_view(user_data):
+    """
+    Returns UserAggregates sums of a non-empty UserPresence view.
+    """
+    dates, starts, ends = columns(user_data)
+    return _aggregate(dates, starts, ends, [len(dates)])[0]
+
+
+def _aggregate(dates, starts, ends, lengths):
+    """
+    Returns sums of consecutive non-empty groups of rows, one per length.
+    """
+    count = len(lengths)
+    dates = numpy.asarray(dates, dtype=numpy.int64)
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    groups = numpy.repeat(numpy.arange(count), lengths)
+    intervals = ends - starts
+
+    def by_group(keys, size, weights=None):
+        """
+        Sums ``weights`` (or counts rows) per group and key.
+        """
+        sums = numpy.bincount(
+            groups * size + keys, weights=weights, minlength=count * size
+        )
+        # weights are summed as floats, exact for any realistic data
+        return sums.astype(numpy.int64).reshape(count, size).tolist()
+
+    weekdays = (dates - 1) % 7
+    # months since 1970-01
+    months = (dates - EPOCH_ORDINAL).astype('datetime64[D]').astype(
+        'datetime64[M]'
+    ).astype(numpy.int64)
+    hours = intervals // 3600
+    first = months.min() if len(months) else 0
+    span = months.max() - first + 1 if len(months) else 1
+    keys, inverse = numpy.unique(
+        groups * span + months - first, return_inverse=True
+    )
+    month_days = numpy.bincount(inverse).tolist()
+    month_sums = numpy.bincount(inverse, weights=hours).astype(
+        numpy.int64
+    ).tolist()
+    month_groups = keys // span
+    month_keys = keys % span + first
+    month_years = numpy.bincount(
+        month_groups * 12 + month_keys % 12, minlength=count * 12
+    ).reshape(count, 12).tolist()
+    result = [
+        {
+            'counts': counts,
+            'intervals': totals,
+            'starts': start_sums,
+            'ends': end_sums,
+            'months': {},
+            'month_hours': month_hours,
+            'month_years': years,
+            'last_day': last_day,
+        }
+        for counts, totals, start_sums, end_sums, month_hours, years, last_day
+        in zip(
+            by_group(weekdays, 7),
+            by_group(weekdays, 7, intervals),
+            by_group(weekdays, 7, starts),
+            by_group(weekdays, 7, ends),
+            by_group(months % 12, 12, hours),
+            month_years,
+            # rows of every user are sorted by date
+            dates[numpy.cumsum(lengths) - 1].tolist(),
+        )
+    ]
+    for group, month, days, total in zip(
+            month_groups.tolist(), month_keys.tolist(), month_days,
+            month_sums):
+        result[group]['months'][1970 + month // 12, month % 12 + 1] = [
+            days, total
+        ]
+    return result
@@ -3,25 +3,41 @@
 Defines views.
 """
 import calendar
-import locale
 import logging
+from datetime import date, timedelta
 
-from flask import abort, redirect, url_for, make_response # pylint: disable=F0401
+from flask import ( # pylint: disable=F0401
+    Response,
+    abort,
+    make_response,
+    redirect,
+    request,
+    url_for,
+)
 from flask.ext.mako import render_template # pylint: disable=F0401
 
+from . import metrics
+from .gevent_server import offload
+from .ingest import parse_date_fast
 from .main import app
+from .refresh import refresher_status
+from .store import seconds_to_time
 from .utils import (
-    assign_ids_to_names_from_xml,
+    aggregate_between,
+    conditional,
+    current_loader,
+    dumps,
+    get_aggregates,
     get_data,
-    group_by_average_start_end_time,
-    group_by_average_monthly_hours,
-    group_by_weekday,
+    get_group_aggregates,
+    get_users,
+    json_response,
     jsonify,
-    mean
+    today,
+    users_listing,
 )
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-locale.setlocale(locale.LC_COLLATE, "pl_PL.UTF-8")
 
 @app.route('/')
 def mainpage():
@@ -32,109 +48,479 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@app.route('/api/v1/users/<int:user_id>', methods=['GET'])
-@jsonify
-def users_view(user_id=None):
+def users_view():
     """
     Users listing for dropdown.
+
+    The sorted listing is serialized once per users xml version and
+    served with a strong ETag, so unchanged data ends in 304.
     """
-    data = get_data()
-    assigned_data = assign_ids_to_names_from_xml(data, user_id)
-    result = []
+    body, etag = users_listing()
+    return json_response(body, etag)
 
-    if len(assigned_data) == 2: #single user returned
-            return assigned_data
-    else: #transform dict into list so we can sort it with sorted()
-        for k, v in assigned_data.iteritems():
-            v['id'] = k
-            result.append(v)
 
-        result = sorted(result, key=lambda k: k['name'], cmp=locale.strcoll)
+@app.route('/api/v1/users/<int:user_id>', methods=['GET'])
+@jsonify
+def user_view(user_id):
+    """
+    Returns name and avatar of given user.
+    """
+    users = get_users()
+    if user_id not in users:
+        log.debug('User %s not found!', user_id)
+        abort(404)
 
-    return result
+    return users[user_id]
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@conditional()
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    return mean_time_weekday(get_user_aggregates(user_id, date_range()))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@conditional()
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(get_user_aggregates(user_id, date_range()))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@conditional()
 @jsonify
 def presence_start_end_view(user_id):
     """
     Returns averaged start and end time grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
-
-    result = [
-        [calendar.day_abbr[part[0]], part[1], part[2]]
-        for part in group_by_average_start_end_time(data[user_id])
-    ]
-
-    return result
+    return presence_start_end(get_user_aggregates(user_id, date_range()))
 
 
 @app.route('/api/v1/average_by_month/<int:user_id>', methods=['GET'])
+@conditional()
 @jsonify
 def average_by_month_view(user_id):
     """
     Returns average hours worked per month.
     """
+    return average_by_month(get_user_aggregates(user_id, date_range()))
+
+
+@app.route('/api/v1/bulk', methods=['GET'])
+@conditional()
+def bulk_view():
+    """
+    Returns chosen statistics of many users at once.
+
+    ``users`` is a comma separated list of user ids or "all",
+    ``metrics`` a comma separated list of METRICS names, all by default.
+    The response maps user ids to ``{metric: result}`` and is streamed
+    user by user; unknown users map to null. Dates can be limited like
+    in the other statistics endpoints, see date_range().
+    """
     data = get_data()
-    if user_id not in data:
+    aggregates = current_loader().aggregates
+    first_last = date_range()
+    user_ids = requested_user_ids(aggregates)
+    requested = request.args.get('metrics')
+    requested = requested.split(',') if requested else sorted(METRICS)
+    if not set(requested) <= set(METRICS):
+        abort(400)
+
+    def generate():
+        """
+        Yields JSON of every user in turn.
+        """
+        yield '{'
+        for i, user_id in enumerate(user_ids):
+            user_aggregates = offload(aggregates.get, user_id)
+            if user_aggregates is not None and first_last is not None:
+                user_aggregates = offload(
+                    aggregate_between, user_id, first_last[0], first_last[1],
+                    data, aggregates
+                )
+            result = None if user_aggregates is None else {
+                metric: METRICS[metric](user_aggregates)
+                for metric in requested
+            }
+            yield '{0}"{1}":{2}'.format(
+                ',' if i else '', user_id, dumps(result)
+            )
+        yield '}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+def requested_user_ids(aggregates):
+    """
+    Returns ids of users requested in ``users`` query string argument.
+
+    ``users`` is a comma separated list of user ids or "all", default.
+    Aborts with 400 on invalid ids.
+    """
+    users = request.args.get('users', 'all')
+    if users == 'all':
+        return offload(sorted, aggregates)
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        abort(400)
+
+
+def date_range():
+    """
+    Returns ``(first, last)`` dates requested in query string or None.
+
+    ``from`` and ``to`` take YYYY-MM-DD dates, both inclusive.
+    ``last_weeks`` limits data to N weeks ending with ``to`` or today.
+    Aborts with 400 on invalid values.
+    """
+    args = request.args
+    if not any(key in args for key in ('from', 'to', 'last_weeks')):
+        return None
+    try:
+        first, last = [
+            date.fromordinal(parse_date_fast(args[key]))
+            if args.get(key) else None
+            for key in ('from', 'to')
+        ]
+        if args.get('last_weeks'):
+            weeks = int(args['last_weeks'])
+            if weeks < 1:
+                raise ValueError(weeks)
+            last = last or today()
+            window_start = last - timedelta(weeks=weeks) + timedelta(1)
+            first = max(first, window_start) if first else window_start
+    except (ValueError, OverflowError):
+        # OverflowError comes from windows reaching before year 1
+        abort(400)
+    return first, last
+
+
+def get_user_aggregates(user_id, first_last=None):
+    """
+    Returns aggregates of given user, aborts with 404 if there are none.
+
+    Without date range precomputed aggregates are returned, otherwise
+    only rows within ``(first, last)`` dates are aggregated.
+    """
+    user_aggregates = offload(get_aggregates().get, user_id)
+    if user_aggregates is None:
         log.debug('User %s not found!', user_id)
         abort(404)
+    if first_last is None:
+        return user_aggregates
+    return offload(aggregate_between, user_id, *first_last)
+
+
+def mean_time_weekday(user_aggregates):
+    """
+    Mean presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], mean_time)
+        for weekday, mean_time
+        in enumerate(user_aggregates.weekday_means())
+    ]
+
 
+def presence_weekday(user_aggregates):
+    """
+    Total presence time grouped by weekday, with chart header.
+    """
     result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total
+        in enumerate(user_aggregates.weekday_totals())
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(user_aggregates):
+    """
+    Averaged start and end time grouped by weekday.
+    """
+    return [
+        [calendar.day_abbr[part[0]], part[1], part[2]]
+        for part in user_aggregates.start_end_means()
+    ]
+
+
+def average_by_month(user_aggregates):
+    """
+    Average hours worked per month.
+    """
+    return [
         [
             calendar.month_abbr[month_count], number_of_hours
             if number_of_hours else 0
         ]
         for month_count, number_of_hours
-        in enumerate(group_by_average_monthly_hours(data[user_id]), start=1)
+        in enumerate(user_aggregates.monthly_averages(), start=1)
     ]
 
-    return result
+
+# statistics available through the bulk endpoint
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+    'average_by_month': average_by_month,
+}
+
+
+def all_metrics(aggregates):
+    """
+    Results of all METRICS for given aggregates.
+    """
+    return {metric: METRICS[metric](aggregates) for metric in METRICS}
+
+
+@app.route('/api/v1/company', methods=['GET'])
+@conditional()
+@jsonify
+def company_view():
+    """
+    Returns statistics of everyone's presence taken together.
+    """
+    everyone, _ = get_group_aggregates()
+    return dict(all_metrics(everyone), users=offload(len, get_aggregates()))
+
+
+@app.route('/api/v1/groups', methods=['GET'])
+@conditional(users=True)
+@jsonify
+def groups_view():
+    """
+    Returns names and numbers of members of groups in users xml.
+    """
+    _, groups = get_group_aggregates()
+    return [
+        {'name': name, 'users': members}
+        for name, (members, _) in sorted(groups.iteritems())
+    ]
+
+
+@app.route('/api/v1/groups/<group>', methods=['GET'])
+@conditional(users=True)
+@jsonify
+def group_view(group):
+    """
+    Returns statistics of presence of group members taken together.
+    """
+    _, groups = get_group_aggregates()
+    if group not in groups:
+        log.debug('Group %s not found!', group)
+        abort(404)
+    members, aggregates = groups[group]
+    return dict(all_metrics(aggregates), users=members)
+
+
+# mimetypes of export formats
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def export_response(lines, name):
+    """
+    Streams lines of export in format requested in query string.
+
+    ``lines`` is called with the format, ``csv`` or ``ndjson`` (default
+    ``csv``), and yields the body piece by piece. Aborts with 400 on
+    unknown format.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    response = Response(
+        lines(export_format), mimetype=EXPORT_FORMATS[export_format]
+    )
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={0}.{1}'.format(name, export_format)
+    return response
+
+
+@app.route('/api/v1/export/rows', methods=['GET'])
+@conditional()
+def export_rows_view():
+    """
+    Streams daily presence rows of many users as CSV or NDJSON.
+
+    Every row holds user id, date and start and end time. Users are
+    chosen like in the bulk endpoint and dates like in the statistics
+    endpoints, see requested_user_ids() and date_range(); unknown users
+    are skipped. One user's rows are formatted at a time.
+    """
+    data = get_data()
+    user_ids = requested_user_ids(data)
+    first_last = date_range()
+
+    def lines(export_format):
+        """
+        Yields rows of every user in turn.
+        """
+        if export_format == 'csv':
+            yield 'user_id,date,start,end\r\n'
+            template = '{0},{1},{2},{3}\r\n'
+        else:
+            template = (
+                '{{"user_id":{0},"date":"{1}","start":"{2}","end":"{3}"}}\n'
+            )
+        for user_id in user_ids:
+            presence = offload(data.get, user_id)
+            if presence is None:
+                continue
+            if first_last is not None:
+                presence = presence.between(*first_last)
+            yield ''.join(
+                template.format(
+                    user_id,
+                    date.fromordinal(day).isoformat(),
+                    seconds_to_time(start).isoformat(),
+                    seconds_to_time(end).isoformat(),
+                )
+                for day, start, end in presence.rows()
+            )
+
+    return export_response(lines, 'presence')
+
+
+# columns of the CSV export of aggregates, see aggregate_values()
+AGGREGATE_COLUMNS = (
+    ['mean_time_' + day for day in calendar.day_abbr] +
+    ['presence_' + day for day in calendar.day_abbr] +
+    [
+        prefix + day
+        for day in calendar.day_abbr for prefix in ('start_', 'end_')
+    ] +
+    ['hours_' + month for month in calendar.month_abbr[1:]]
+)
+
+
+def aggregate_values(user_aggregates):
+    """
+    Flattens aggregates into values of AGGREGATE_COLUMNS.
+    """
+    values = user_aggregates.weekday_means()
+    values.extend(user_aggregates.weekday_totals())
+    for _, start, end in user_aggregates.start_end_means():
+        values.extend((start, end))
+    values.extend(
+        hours or 0 for hours in user_aggregates.monthly_averages()
+    )
+    return values
+
+
+@app.route('/api/v1/export/aggregates', methods=['GET'])
+@conditional()
+def export_aggregates_view():
+    """
+    Streams statistics of many users as CSV or NDJSON.
+
+    CSV has AGGREGATE_COLUMNS of one user per line, NDJSON one object
+    per user with ``user_id`` and results of all METRICS, like the bulk
+    endpoint. Users and dates are chosen like in export_rows_view();
+    unknown users are skipped. Data taken at the start serves the whole
+    response, even if it gets reloaded meanwhile.
+    """
+    data = get_data()
+    aggregates = current_loader().aggregates
+    user_ids = requested_user_ids(aggregates)
+    first_last = date_range()
+
+    def lines(export_format):
+        """
+        Yields a line of every user in turn.
+        """
+        if export_format == 'csv':
+            yield ','.join(['user_id'] + AGGREGATE_COLUMNS) + '\r\n'
+        for user_id in user_ids:
+            user_aggregates = offload(aggregates.get, user_id)
+            if user_aggregates is None:
+                continue
+            if first_last is not None:
+                user_aggregates = offload(
+                    aggregate_between, user_id, first_last[0], first_last[1],
+                    data, aggregates
+                )
+            if export_format == 'ndjson':
+                yield dumps(
+                    dict(all_metrics(user_aggregates), user_id=user_id)
+                ) + '\n'
+            else:
+                yield ','.join(
+                    [str(user_id)] +
+                    [dumps(value) for value in aggregate_values(
+                        user_aggregates
+                    )]
+                ) + '\r\n'
+
+    return export_response(lines, 'aggregates')
+
+
+@app.route('/api/v1/status', methods=['GET'])
+@jsonify
+def status_view():
+    """
+    Returns state of loaded data and of the background refresher.
+    """
+    loader = current_loader()
+    store = loader.store
+    return {
+        'data': {
+            'version': loader.version,
+            'users': len(store) if store is not None else 0,
+            'rows': store.row_count if store is not None else 0,
+            'full_loads': getattr(loader, 'full_loads', 0),
+            'tail_loads': getattr(loader, 'tail_loads', 0),
+            'snapshot_loads': getattr(loader, 'snapshot_loads', 0),
+            'shared_attaches': getattr(loader, 'attaches', 0),
+            'lazy_hits': getattr(loader, 'hits', 0),
+            'lazy_misses': getattr(loader, 'misses', 0),
+        },
+        'refresher': refresher_status(app),
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns counters and latency histograms in Prometheus text format.
+
+    Available only with METRICS_ENABLED set.
+    """
+    if not metrics.enabled():
+        abort(404)
+    loader = current_loader()
+    store = loader.store
+    body = metrics.render([
+        ('presence_data_version', 'Version of loaded presence data.',
+         loader.version),
+        ('presence_data_users', 'Users in loaded presence data.',
+         len(store) if store is not None else 0),
+        ('presence_data_rows', 'Rows in loaded presence data.',
+         store.row_count if store is not None else 0),
+        ('presence_data_full_loads', 'Full parses of DATA_CSV.',
+         getattr(loader, 'full_loads', 0)),
+        ('presence_data_tail_loads', 'Parses of rows appended to DATA_CSV.',
+         getattr(loader, 'tail_loads', 0)),
+        ('presence_lazy_hits', 'Users found parsed in lazy mode.',
+         getattr(loader, 'hits', 0)),
+        ('presence_lazy_misses', 'Users parsed on demand in lazy mode.',
+         getattr(loader, 'misses', 0)),
+    ])
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/show')